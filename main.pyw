@@ -1,5 +1,6 @@
 from threading import Thread, Lock
 import logging
+import multiprocessing
 import webview
 from time import sleep
 from server import run_server
@@ -26,6 +27,7 @@ def url_ok(url, port):
         return False
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     logger.debug("Starting server")
     t = Thread(target=run_server)
     t.daemon = True
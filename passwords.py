@@ -0,0 +1,43 @@
+'''
+    Password hashing for the admin accounts.
+
+    The hashes are deliberately slow, so the server runs these functions in a small process pool
+    instead of on its request threads. The scheme and rounds are passed in with every call, which
+    lets the worker processes stay independent of the server's config. This module does not import
+    the server, so it is cheap to load in the worker processes.
+'''
+from passlib.context import CryptContext
+from passlib.registry import get_crypt_handler
+
+### Schemes a stored hash may use, the configured one is used for new hashes and the others are
+### upgraded to it on the next successful login
+SCHEMES = ["sha256_crypt", "sha512_crypt", "pbkdf2_sha256", "pbkdf2_sha512"]
+
+### CryptContext per (scheme, rounds), built once in each process
+contexts = {}
+
+### Rounds of 0 use passlib's default for the scheme. Hashes with any other rounds count as outdated.
+def context(scheme, rounds):
+    key = (scheme, rounds)
+    if key not in contexts:
+        if scheme not in SCHEMES:
+            raise ValueError("Unknown password scheme: " + str(scheme))
+        rounds = rounds if rounds > 0 else get_crypt_handler(scheme).default_rounds
+        contexts[key] = CryptContext(schemes=SCHEMES, default=scheme, deprecated="auto", **{
+            scheme + "__default_rounds": rounds,
+            scheme + "__min_rounds": rounds,
+            scheme + "__max_rounds": rounds
+        })
+    return contexts[key]
+
+def hash(password, scheme, rounds):
+    return context(scheme, rounds).hash(password)
+
+### Returns (matched, new hash), the new hash is None unless the stored one should be replaced
+def verify(password, stored, scheme, rounds):
+    passwords = context(scheme, rounds)
+    try:
+        return passwords.verify_and_update(password, stored)
+    except ValueError:
+        # empty or malformed hash in the database
+        return False, None
@@ -0,0 +1,335 @@
+'''
+    Server side PDF rendering for fee receipts and student ID cards.
+
+    A small PDF writer using the standard Type 1 fonts, so nothing has to be installed or bundled.
+    Pages are laid out in inches from the top left corner, the same as the jsPDF code in the
+    templates, which keeps the receipts and cards identical to the ones drawn in the browser.
+    This module does not import the server, so it is cheap to load in the print worker processes.
+'''
+import struct
+import zlib
+
+### Standard fonts, jsPDF's "arial" is Helvetica
+FONTS = {
+    ("arial", "normal"): ("F1", "Helvetica"),
+    ("arial", "bold"): ("F2", "Helvetica-Bold"),
+    ("courier", "normal"): ("F3", "Courier"),
+    ("courier", "bold"): ("F4", "Courier-Bold")
+}
+
+
+### Escape a string for a PDF literal. Page content is encoded to Windows-1252 when it is written,
+### characters outside it come out as "?".
+def pdfstring(s):
+    return "(" + str(s).replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)").replace("\r", "").replace("\n", " ") + ")"
+
+def color(rgb, operator):
+    return "%.4g %.4g %.4g %s" % (rgb[0] / 255.0, rgb[1] / 255.0, rgb[2] / 255.0, operator)
+
+
+### An image XObject, read from a JPEG or non-interlaced PNG without transparency.
+### Anything else (GIF, PNG with alpha) raises ValueError.
+class PDFImage:
+    def __init__(self, data, key=None):
+        self.key = key
+        self.decodeparms = None
+        self.palette = None
+        if data[:2] == b"\xff\xd8":
+            self.readjpeg(data)
+        elif data[:8] == b"\x89PNG\r\n\x1a\n":
+            self.readpng(data)
+        else:
+            raise ValueError("Unsupported image format.")
+
+    def readjpeg(self, data):
+        i = 2
+        while i < len(data):
+            while data[i] == 0xFF:
+                i += 1
+            marker = data[i]
+            i += 1
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+                continue
+            length = struct.unpack(">H", data[i:i + 2])[0]
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                bits, self.height, self.width, components = struct.unpack(">BHHB", data[i + 2:i + 8])
+                self.bits = bits
+                self.colorspace = {1: "/DeviceGray", 3: "/DeviceRGB", 4: "/DeviceCMYK"}[components]
+                self.filter = "/DCTDecode"
+                self.data = data
+                return
+            i += length
+        raise ValueError("Invalid JPEG image.")
+
+    def readpng(self, data):
+        i = 8
+        idat = []
+        colortype = None
+        interlace = None
+        while i < len(data):
+            length, chunk = struct.unpack(">I4s", data[i:i + 8])
+            body = data[i + 8:i + 8 + length]
+            if chunk == b"IHDR":
+                self.width, self.height, self.bits, colortype, compression, filtering, interlace = struct.unpack(">IIBBBBB", body)
+            elif chunk == b"PLTE":
+                self.palette = body
+            elif chunk == b"IDAT":
+                idat.append(body)
+            elif chunk == b"IEND":
+                break
+            i += length + 12
+        if colortype is None:
+            raise ValueError("Invalid PNG image.")
+        if interlace != 0 or colortype not in (0, 2, 3):
+            raise ValueError("Unsupported PNG image.")
+        if colortype == 3 and self.palette is None:
+            raise ValueError("Invalid PNG image.")
+        colors = 3 if colortype == 2 else 1
+        if colortype == 3:
+            self.colorspace = "[/Indexed /DeviceRGB " + str(len(self.palette) // 3 - 1) + " %s]"
+        else:
+            self.colorspace = "/DeviceRGB" if colortype == 2 else "/DeviceGray"
+        self.filter = "/FlateDecode"
+        self.decodeparms = "<< /Predictor 15 /Colors %d /BitsPerComponent %d /Columns %d >>" % (colors, self.bits, self.width)
+        self.data = b"".join(idat)
+
+
+### Read an image file, returns None when it is missing or in a format that can't be embedded
+def loadimage(path):
+    try:
+        with open(path, "rb") as f:
+            return PDFImage(f.read(), key=path)
+    except (IOError, OSError, ValueError, KeyError, struct.error, IndexError):
+        return None
+
+
+### One page, drawn with the same calls (and units) as jsPDF.
+### Fill color and font are only written out when they change.
+class PDFPage:
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.ops = []
+        self.images = []
+        self.fonts = set()
+        self.font = "arial"
+        self.fonttype = "normal"
+        self.fontsize = 16
+        self.textcolor = (0, 0, 0)
+        self.fillcolor = (0, 0, 0)
+        self.current = {"rg": None, "Tf": None}
+        self.data = None
+
+    def setfont(self, font):
+        self.font = font
+
+    def setfonttype(self, fonttype):
+        self.fonttype = fonttype
+
+    def setfontsize(self, size):
+        self.fontsize = size
+
+    def setlinewidth(self, width):
+        self.ops.append("%.6g w" % (width * 72))
+
+    def setdrawcolor(self, r, g=None, b=None):
+        self.ops.append(color(self.rgb(r, g, b), "RG"))
+
+    def setfillcolor(self, r, g=None, b=None):
+        self.fillcolor = self.rgb(r, g, b)
+
+    def settextcolor(self, r, g=None, b=None):
+        self.textcolor = self.rgb(r, g, b)
+
+    def rgb(self, r, g, b):
+        return (r, r, r) if g is None else (r, g, b)
+
+    def setstate(self, operator, value):
+        if self.current[operator] != value:
+            self.current[operator] = value
+            self.ops.append(value)
+
+    def text(self, x, y, s):
+        name = FONTS[(self.font, self.fonttype)][0]
+        self.fonts.add(name)
+        self.setstate("rg", color(self.textcolor, "rg"))
+        self.ops.append("BT /%s %.6g Tf %.6g %.6g Td %s Tj ET" % (name, self.fontsize, x * 72, (self.height - y) * 72, pdfstring(s)))
+
+    def line(self, x1, y1, x2, y2):
+        self.ops.append("%.6g %.6g m %.6g %.6g l S" % (x1 * 72, (self.height - y1) * 72, x2 * 72, (self.height - y2) * 72))
+
+    def rect(self, x, y, w, h, style="S"):
+        self.setstate("rg", color(self.fillcolor, "rg"))
+        self.ops.append("%.6g %.6g %.6g %.6g re %s" % (x * 72, (self.height - y - h) * 72, w * 72, h * 72, {"F": "f", "FD": "B", "DF": "B"}.get(style, "S")))
+
+    def addimage(self, image, x, y, w, h):
+        if image is None:
+            return
+        name = "I" + str(len(self.images))
+        self.images.append(image)
+        self.ops.append("q %.6g 0 0 %.6g %.6g %.6g cm /%s Do Q" % (w * 72, h * 72, x * 72, (self.height - y - h) * 72, name))
+
+    ### The compressed content stream. Print jobs call this in the worker processes so the
+    ### compression is spread across them too, and the ops are dropped before the page is sent back.
+    def content(self):
+        if self.data is None:
+            self.data = zlib.compress("\n".join(self.ops).encode("cp1252", "replace"))
+            self.ops = None
+        return self.data
+
+
+### A list of pages written out as one PDF file. Images shared by several pages
+### (the logo on every ID card) are stored once.
+class PDFDocument:
+    def __init__(self, pages=None):
+        self.pages = list(pages or [])
+
+    def output(self):
+        objects = []
+
+        def add(body):
+            objects.append(body)
+            return len(objects)
+
+        catalog = add(None)
+        pagesobj = add(None)
+        fonts = {}
+        for name, basefont in FONTS.values():
+            fonts[name] = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /" + basefont.encode() + b" /Encoding /WinAnsiEncoding >>")
+        images = {}
+        kids = []
+        for page in self.pages:
+            xobjects = []
+            for i, image in enumerate(page.images):
+                key = image.key if image.key is not None else id(image)
+                if key not in images:
+                    images[key] = self.addimage(add, image)
+                xobjects.append(("/I" + str(i) + " " + str(images[key]) + " 0 R").encode())
+            content = page.content()
+            contentobj = add(b"<< /Length " + str(len(content)).encode() + b" /Filter /FlateDecode >>\nstream\n" + content + b"\nendstream")
+            resources = b"<< /Font << " + b" ".join(("/" + name + " " + str(fonts[name]) + " 0 R").encode() for name in sorted(page.fonts)) + b" >>"
+            if len(xobjects) > 0:
+                resources += b" /XObject << " + b" ".join(xobjects) + b" >>"
+            resources += b" >>"
+            kids.append(add(b"<< /Type /Page /Parent " + str(pagesobj).encode() + b" 0 R /MediaBox [0 0 " + ("%.6g %.6g" % (page.width * 72, page.height * 72)).encode() + b"] /Resources " + resources + b" /Contents " + str(contentobj).encode() + b" 0 R >>"))
+        objects[catalog - 1] = b"<< /Type /Catalog /Pages " + str(pagesobj).encode() + b" 0 R >>"
+        objects[pagesobj - 1] = b"<< /Type /Pages /Kids [" + b" ".join(str(kid).encode() + b" 0 R" for kid in kids) + b"] /Count " + str(len(kids)).encode() + b" >>"
+
+        out = [b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"]
+        size = len(out[0])
+        offsets = []
+        for i, body in enumerate(objects):
+            offsets.append(size)
+            chunk = str(i + 1).encode() + b" 0 obj\n" + body + b"\nendobj\n"
+            out.append(chunk)
+            size += len(chunk)
+        xref = [b"xref\n0 " + str(len(objects) + 1).encode() + b"\n0000000000 65535 f \n"]
+        xref.extend(("%010d 00000 n \n" % offset).encode() for offset in offsets)
+        out.extend(xref)
+        out.append(b"trailer\n<< /Size " + str(len(objects) + 1).encode() + b" /Root " + str(catalog).encode() + b" 0 R >>\nstartxref\n" + str(size).encode() + b"\n%%EOF\n")
+        return b"".join(out)
+
+    def addimage(self, add, image):
+        colorspace = image.colorspace
+        if image.palette is not None:
+            palette = add(b"<< /Length " + str(len(image.palette)).encode() + b" >>\nstream\n" + image.palette + b"\nendstream")
+            colorspace = colorspace % (str(palette) + " 0 R")
+        header = "<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s /BitsPerComponent %d /Filter %s" % (image.width, image.height, colorspace, image.bits, image.filter)
+        if image.decodeparms is not None:
+            header += " /DecodeParms " + image.decodeparms
+        header += " /Length %d >>" % len(image.data)
+        return add(header.encode() + b"\nstream\n" + image.data + b"\nendstream")
+
+
+'''
+    Layouts
+'''
+### Fee receipt, a student copy and an office copy on one A4 page (downloadfeereceipt.html)
+def feereceipt(record, institutionname):
+    page = PDFPage(8.27, 11.69)
+    for top, copy in ((0.0, "Student Copy"), (5.0, "Office Copy")):
+        page.setfont("arial")
+        page.setfontsize(16)
+        page.text(0.5, top + 0.5, institutionname)
+        page.setfonttype("normal")
+        page.setfontsize(12)
+        page.text(0.5, top + 0.8, "Fee Receipt - ( " + copy + " )")
+        page.setfont("courier")
+        page.setfontsize(12)
+        page.setlinewidth(0.01)
+        rows = [
+            ("Receipt ID: ", record["id"]),
+            ("Student ID: ", record["studentID"]),
+            ("Student Name: ", record["studentName"]),
+            ("Father Name: ", record["studentFrName"]),
+            ("Fee For: ", record["feefor"]),
+            ("Deposited On: ", record["date"]),
+            ("Fee Deposited: ", str(record["depositedfee"]) + "/-")
+        ]
+        for i, (label, value) in enumerate(rows):
+            y = top + 1.3 + i * 0.3
+            page.text(0.5, y, label)
+            page.text(2.2, y, "" if value is None else value)
+            page.line(0.5, y + 0.1, 7.75, y + 0.1)
+        page.line(0.5, top + 3.8, 2, top + 3.8)
+        page.text(0.5, top + 4.0, "Signature/Stamp")
+        if copy == "Student Copy":
+            page.line(0.0, 4.8, 8.27, 4.8)
+    return page
+
+### Student ID card, 3.5 x 2 inches (studentprofile.html)
+def idcard(student, photo, logo):
+    page = PDFPage(3.5, 2)
+    page.setfont("arial")
+    page.setdrawcolor(0)
+    page.setfillcolor(253, 253, 253)
+    page.rect(0, 0, 3.5, 2, "F")
+    page.setfillcolor(24, 79, 130)
+    page.rect(3.3, 0, 0.2, 2, "F")
+
+    page.settextcolor(253, 253, 253)
+    page.setfontsize(8)
+    page.setfonttype("bold")
+    for i, letter in enumerate("STUDENT CARD"):
+        if letter != " ":
+            page.text(3.36, 0.2 + i * 0.15, letter)
+
+    page.setfonttype("normal")
+    page.settextcolor(43, 105, 159)
+    page.setfontsize(10)
+    page.text(0.15, 0.25, "Student ID: %s" % student["id"])
+    page.text(0.15, 0.45, "Name: %s %s" % (student["firstname"] or "", student["lastname"] or ""))
+    page.text(0.15, 0.65, "FName: %s" % (student["fathername"] or ""))
+    page.text(0.15, 0.85, "Class: %s" % (student["class"] or ""))
+
+    page.addimage(photo, 0.15, 1, 0.85, 0.85)
+    page.addimage(logo, 2.28, 0.96, 0.9, 0.9)
+    return page
+
+
+'''
+    Print jobs, run in the worker processes one chunk of rows at a time
+'''
+images_cache = {}
+
+def cachedimage(path):
+    if path not in images_cache:
+        images_cache[path] = loadimage(path)
+    return images_cache[path]
+
+def feereceipts(records, institutionname):
+    pages = [feereceipt(record, institutionname) for record in records]
+    for page in pages:
+        page.content()
+    return pages
+
+### Each student carries a "photo" path. Photos that can't be embedded fall back to the default picture.
+def idcards(students, logopath, defaultphotopath):
+    logo = cachedimage(logopath)
+    pages = []
+    for student in students:
+        photo = loadimage(student["photo"]) or cachedimage(defaultphotopath)
+        page = idcard(student, photo, logo)
+        page.content()
+        pages.append(page)
+    return pages
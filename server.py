@@ -9,44 +9,128 @@ from flask import (
     url_for,
     jsonify,
     make_response,
+    send_from_directory,
     g
 )
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from werkzeug.datastructures import CallbackDict
+from itsdangerous import Signer, BadSignature
 from flask_compress import Compress
 import sqlalchemy
-from passlib.hash import sha256_crypt
+import sqlite3
 import operator
+import collections
+import itertools
 import uuid
+import configparser
+import threading
+import time
+import csv
+import re
+import io
+import zipfile
+import click
+import concurrent.futures
+import multiprocessing
+import hashlib
+import gzip
+import mimetypes
+from PIL import Image, ImageOps
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import waitress
+except ImportError:
+    waitress = None
+try:
+    import gunicorn.app.base
+except ImportError:
+    # not available on Windows
+    gunicorn = None
+import pdf
+import passwords
 
 ### CS50 wrapper for SQLAlchemy
 class SQL(object):
     """Wrap SQLAlchemy to provide a simple SQL API."""
 
-    def __init__(self, url):
+    # number of distinct statements kept parsed and compiled before the caches are reset
+    STATEMENT_CACHE_SIZE = 500
+
+    # statements whose result is the ID of the inserted row rather than a row count
+    INSERTS = ("INSERT", "REPLACE")
+
+    def __init__(self, url, pragmas=None, **kwargs):
         """
         Create instance of sqlalchemy.engine.Engine.
 
         URL should be a string that indicates database dialect and connection arguments.
+        Keyword arguments are passed on to create_engine. Pragmas, a list of (name, value) pairs,
+        are applied in order to every new DBAPI connection.
 
         http://docs.sqlalchemy.org/en/latest/core/engines.html#sqlalchemy.create_engine
         """
         try:
-            self.engine = sqlalchemy.create_engine(url)
+            # parsed text() constructs keyed by SQL text, and their compiled forms keyed by construct
+            # http://docs.sqlalchemy.org/en/latest/core/connections.html#sqlalchemy.engine.Connection.execution_options.params.compiled_cache
+            self.statements = {}
+            self.compiled = {}
+            engine = sqlalchemy.create_engine(url, **kwargs)
+
+            # let SQLAlchemy, not pysqlite, decide where transactions begin, so that reads done inside
+            # transaction() are part of the transaction and the write lock is taken up front
+            # http://docs.sqlalchemy.org/en/latest/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl
+            @sqlalchemy.event.listens_for(engine, "connect")
+            def on_connect(dbapi_connection, connection_record):
+                dbapi_connection.isolation_level = None
+                if pragmas:
+                    cursor = dbapi_connection.cursor()
+                    for name, value in pragmas:
+                        cursor.execute("PRAGMA " + name + "=" + str(value))
+                    cursor.close()
+
+            @sqlalchemy.event.listens_for(engine, "begin")
+            def on_begin(connection):
+                connection.execute("BEGIN IMMEDIATE")
+
+            self.engine = engine.execution_options(compiled_cache=self.compiled)
         except Exception as e:
             raise RuntimeError(e)
 
+    def statement(self, text):
+        """
+        Return the cached text() construct of a SQL statement, parsing it on first use.
+        """
+        statement = self.statements.get(text)
+        if statement is None:
+            if len(self.statements) >= self.STATEMENT_CACHE_SIZE:
+                self.statements.clear()
+                self.compiled.clear()
+            statement = sqlalchemy.text(text)
+            self.statements[text] = statement
+        return statement
+
     def execute(self, text, *multiparams, **params):
         """
         Execute a SQL statement.
         """
+        return self.run(self.engine, text, multiparams, params)
+
+    def run(self, connectable, text, multiparams, params):
+        """
+        Execute a SQL statement on an engine or connection.
+        """
         try:
 
-            # bind parameters before statement reaches database, so that bound parameters appear in exceptions
+            # pass values as real bound parameters so the compiled statement (and the driver's
+            # prepared statement) is reused across calls with different values
             # http://docs.sqlalchemy.org/en/latest/core/sqlelement.html#sqlalchemy.sql.expression.text
-            # https://groups.google.com/forum/#!topic/sqlalchemy/FfLwKT1yQlg
-            # http://docs.sqlalchemy.org/en/latest/core/connections.html#sqlalchemy.engine.Engine.execute
-            # http://docs.sqlalchemy.org/en/latest/faq/sqlexpressions.html#how-do-i-render-sql-expressions-as-strings-possibly-with-bound-parameters-inlined
-            statement = sqlalchemy.text(text).bindparams(*multiparams, **params)
-            result = self.engine.execute(str(statement.compile(compile_kwargs={"literal_binds": True})))
+            statement = self.statement(text)
+            if multiparams:
+                statement = statement.bindparams(*multiparams)
+            result = connectable.execute(statement, **params)
 
             # if SELECT (or INSERT with RETURNING), return result set as list of dict objects
             if result.returns_rows:
@@ -54,7 +138,8 @@ class SQL(object):
                 return [dict(row) for row in rows]
 
             # if INSERT, return primary key value for a newly inserted row
-            elif result.lastrowid is not None:
+            # (pysqlite sets lastrowid after every statement, so look at the statement itself)
+            elif text.split(None, 1)[0].upper() in self.INSERTS and result.lastrowid is not None:
                 return result.lastrowid
 
             # if DELETE or UPDATE (or INSERT without RETURNING), return number of rows matched
@@ -69,6 +154,404 @@ class SQL(object):
         except Exception as e:
             raise RuntimeError(e)
 
+    def executemany(self, text, rows):
+        """
+        Execute a SQL statement once for each dict of parameters in rows.
+        """
+        return self.runmany(self.engine, text, rows)
+
+    def runmany(self, connectable, text, rows):
+        """
+        Execute a SQL statement on an engine or connection once for each dict of parameters in rows,
+        in one DBAPI executemany() call. Returns the total number of rows affected.
+        """
+        if len(rows) < 1:
+            return 0
+        try:
+            return connectable.execute(self.statement(text), rows).rowcount
+
+        # if constraint violated, return None
+        except sqlalchemy.exc.IntegrityError:
+            return None
+
+        # else raise error
+        except Exception as e:
+            raise RuntimeError(e)
+
+    def transaction(self):
+        """
+        Return a context manager that runs statements in a single transaction.
+
+            with db.transaction() as transaction:
+                transaction.execute("UPDATE ...", ...)
+
+        The transaction commits when the block ends and rolls back if it raises.
+        """
+        return SQLTransaction(self)
+
+    def update(self, table, id, values, version=None):
+        """
+        Update a row with only the columns whose value changed, in one UPDATE statement.
+
+        Values maps column names to submitted values. If a version column is named, it is
+        incremented along with any change. Returns the number of changed columns (0 if none),
+        or None if there is no row with that ID.
+        """
+        with self.transaction() as transaction:
+            row = transaction.execute("SELECT * FROM " + table + " WHERE id=:id", id=id)
+            if len(row) < 1:
+                return None
+            changed = {}
+            for column, value in values.items():
+                current = row[0][column]
+                # SQLite column affinity stores "80" and 80 the same way, so compare them as text
+                if current is None or value is None:
+                    if current is not value:
+                        changed[column] = value
+                elif str(current) != str(value):
+                    changed[column] = value
+            if len(changed) > 0:
+                assignments = [column + "=:" + column for column in sorted(changed)]
+                if version is not None:
+                    assignments.append(version + "=" + version + " + 1")
+                changed["id"] = id
+                transaction.execute("UPDATE " + table + " SET " + ", ".join(assignments) + " WHERE id=:id", **changed)
+                del changed["id"]
+            return len(changed)
+
+
+class SQLTransaction(object):
+    """Statements of an SQL instance executed on one connection inside one transaction."""
+
+    def __init__(self, database):
+        self.database = database
+
+    def __enter__(self):
+        self.connection = self.database.engine.connect()
+        self.transaction = self.connection.begin()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        try:
+            if type is None:
+                self.transaction.commit()
+            else:
+                self.transaction.rollback()
+        finally:
+            self.connection.close()
+        return False
+
+    def execute(self, text, *multiparams, **params):
+        """
+        Execute a SQL statement inside the transaction.
+        """
+        return self.database.run(self.connection, text, multiparams, params)
+
+    def executemany(self, text, rows):
+        """
+        Execute a SQL statement inside the transaction once for each dict of parameters in rows.
+        """
+        return self.database.runmany(self.connection, text, rows)
+
+
+### Month names and their usual abbreviations, whole words only ("Maybe" and "Junior" are no months)
+BILLING_MONTH = r"(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)"
+### A month name, then optionally more months ("Feb/March", "Jan and Feb") and the year they are in
+BILLING_MONTHS = re.compile(r"\b(" + BILLING_MONTH + r")\b(?:[\s,\-/.'&]*(?:and|to|" + BILLING_MONTH + r")\b)*[\s,\-/.']*(\d{4}|\d{2})?\b")
+
+### Normalize the "fee for" text of a fee record to its billing period "YYYY-MM".
+### Understands e.g. "January 2017", "Jan-17", "2017-01", "01/2017". A month name without a year
+### ("March") is taken to be in defaultyear. Returns None if no billing period is found.
+def billingperiod(feefor, defaultyear=None):
+    text = (feefor or "").strip().lower()
+    match = re.search(r"(\d{4})\s*[-/. ]\s*(\d{1,2})\b", text)
+    if match:
+        year, month = int(match.group(1)), int(match.group(2))
+    else:
+        match = re.search(r"\b(\d{1,2})\s*[-/. ]\s*(\d{4}|\d{2})\b", text)
+        if match:
+            month, year = int(match.group(1)), int(match.group(2))
+        else:
+            match = BILLING_MONTHS.search(text)
+            if match is None or (match.group(2) is None and defaultyear is None):
+                return None
+            month = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"].index(match.group(1)[:3]) + 1
+            year = int(match.group(2)) if match.group(2) is not None else int(defaultyear)
+    if year < 100:
+        year += 2000
+    if month < 1 or month > 12:
+        return None
+    return "%04d-%02d" % (year, month)
+
+### Billing period of a fee record: the period named in "fee for" (in the year of deposit if it names no year),
+### or else the month it was deposited in
+def feerecordperiod(feefor, date):
+    if re.match(r"^\d{4}-\d{2}", date or "") is None:
+        return billingperiod(feefor)
+    return billingperiod(feefor, date[:4]) or date[:7]
+
+### Fill in the billing period of the existing fee records (migration 5)
+def backfillfeeperiods(connection):
+    records = connection.execute("SELECT id, feefor, date FROM feerecords").fetchall()
+    connection.executemany("UPDATE feerecords SET period=? WHERE id=?", [(feerecordperiod(feefor, date), id) for id, feefor, date in records])
+
+### Rebuild the fee collection rollups from the fee records (migration 6 and "flask rebuild-rollups")
+FEEROLLUPS_REBUILD = [
+    "DELETE FROM feerollups",
+    "INSERT INTO feerollups (month, class, adminID, deposits, amount) SELECT substr(date, 1, 7), IFNULL(class, ''), IFNULL(adminID, 0), COUNT(*), SUM(depositedfee) FROM feerecords GROUP BY substr(date, 1, 7), IFNULL(class, ''), IFNULL(adminID, 0)"
+]
+
+### Full-text index of the students (see searchstudents), an external content FTS5 table kept in sync
+### by triggers. Names count most towards the rank. SQLite builds without FTS5 skip it.
+STUDENTS_FTS_COLUMNS = ["firstname", "lastname", "fathername", "contact", "address", "class"]
+### Characters other than spaces that separate words in the search without the index
+STUDENTS_SEARCH_SEPARATORS = ["-", ",", ".", "/", "#", "(", ")", "+", "\n"]
+
+def studentsearchindex(connection):
+    try:
+        connection.execute("CREATE VIRTUAL TABLE students_fts USING fts5(" + ", ".join(STUDENTS_FTS_COLUMNS) + ", content='students', content_rowid='id', prefix='1 2 3')")
+    except sqlite3.OperationalError as error:
+        if "fts5" not in str(error):
+            raise
+        return
+    columns = ", ".join(STUDENTS_FTS_COLUMNS)
+    old = ", ".join("OLD." + column for column in STUDENTS_FTS_COLUMNS)
+    new = ", ".join("NEW." + column for column in STUDENTS_FTS_COLUMNS)
+    connection.execute("INSERT INTO students_fts (students_fts, rank) VALUES ('rank', 'bm25(10.0, 10.0, 5.0, 2.0, 1.0, 2.0)')")
+    connection.execute("CREATE TRIGGER students_fts_insert AFTER INSERT ON students BEGIN INSERT INTO students_fts (rowid, " + columns + ") VALUES (NEW.id, " + new + "); END")
+    connection.execute("CREATE TRIGGER students_fts_delete AFTER DELETE ON students BEGIN INSERT INTO students_fts (students_fts, rowid, " + columns + ") VALUES ('delete', OLD.id, " + old + "); END")
+    connection.execute("CREATE TRIGGER students_fts_update AFTER UPDATE OF " + columns + " ON students BEGIN INSERT INTO students_fts (students_fts, rowid, " + columns + ") VALUES ('delete', OLD.id, " + old + "); INSERT INTO students_fts (rowid, " + columns + ") VALUES (NEW.id, " + new + "); END")
+    connection.execute("INSERT INTO students_fts (students_fts) VALUES ('rebuild')")
+
+### Ordered schema migrations. Migration N brings a database from user_version N to N + 1.
+### A migration is a list of SQL statements, or of functions called with the sqlite3 connection.
+### Never edit a migration once it has shipped, append a new one instead.
+### Reference counts of the image blobs (see Images) follow the imgURL of students and admins.
+### A blob URL ends in <40 hex digit hash>.jpg, so the hash is substr(imgURL, -44, 40).
+def blobtriggers(table):
+    blob = "imgURL LIKE '../static/img/db/blobs/%'"
+    return [
+        """CREATE TRIGGER blobs_{0}_insert AFTER INSERT ON {0} WHEN NEW.{1} BEGIN
+            UPDATE blobs SET refs=refs + 1 WHERE hash=substr(NEW.imgURL, -44, 40);
+        END""".format(table, blob),
+        """CREATE TRIGGER blobs_{0}_delete AFTER DELETE ON {0} WHEN OLD.{1} BEGIN
+            UPDATE blobs SET refs=refs - 1 WHERE hash=substr(OLD.imgURL, -44, 40);
+        END""".format(table, blob),
+        """CREATE TRIGGER blobs_{0}_update AFTER UPDATE OF imgURL ON {0} WHEN OLD.imgURL IS NOT NEW.imgURL BEGIN
+            UPDATE blobs SET refs=refs - 1 WHERE hash=substr(OLD.imgURL, -44, 40) AND OLD.{1};
+            UPDATE blobs SET refs=refs + 1 WHERE hash=substr(NEW.imgURL, -44, 40) AND NEW.{1};
+        END""".format(table, blob)
+    ]
+
+### Recount the references of every blob
+BLOBS_RECOUNT = "UPDATE blobs SET refs=(SELECT COUNT(*) FROM students WHERE imgURL LIKE '../static/img/db/blobs/%' AND substr(imgURL, -44, 40)=blobs.hash) + (SELECT COUNT(*) FROM admins WHERE imgURL LIKE '../static/img/db/blobs/%' AND substr(imgURL, -44, 40)=blobs.hash)"
+
+MIGRATIONS = [
+    # 1: student ID lookups of test/fee records (student record pages, deletestudent)
+    [
+        "CREATE INDEX IF NOT EXISTS idx_testrecords_studentID ON testrecords (studentID)",
+        "CREATE INDEX IF NOT EXISTS idx_feerecords_studentID ON feerecords (studentID)"
+    ],
+    # 2: active/inactive student listings sorted by name
+    [
+        "CREATE INDEX IF NOT EXISTS idx_students_status_firstname ON students (status, firstname COLLATE NOCASE, lastname COLLATE NOCASE)"
+    ],
+    # 3: version stamp of the system settings, bumped on every save so cached copies can be refreshed
+    [
+        "ALTER TABLE systemsettings ADD COLUMN version INTEGER NOT NULL DEFAULT 0"
+    ],
+    # 4: dashboard counters kept up to date by triggers, so /home never counts rows.
+    #    monthlycounters are keyed by the YYYY-MM of the record's own date.
+    [
+        "CREATE TABLE counters (name TEXT PRIMARY KEY NOT NULL, value INTEGER NOT NULL DEFAULT 0)",
+        "CREATE TABLE monthlycounters (month TEXT NOT NULL, name TEXT NOT NULL, value INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (month, name))",
+        "INSERT INTO counters (name, value) SELECT 'students_' || status, COUNT(*) FROM students GROUP BY status",
+        "INSERT OR IGNORE INTO counters (name, value) VALUES ('students_Active', 0), ('students_Inactive', 0)",
+        "INSERT INTO counters (name, value) SELECT 'admins', COUNT(*) FROM admins",
+        "INSERT INTO counters (name, value) SELECT 'testrecords', COUNT(*) FROM testrecords",
+        "INSERT INTO counters (name, value) SELECT 'feerecords', COUNT(*) FROM feerecords",
+        "INSERT INTO monthlycounters (month, name, value) SELECT substr(date, 1, 7), 'testrecords', COUNT(*) FROM testrecords GROUP BY substr(date, 1, 7)",
+        "INSERT INTO monthlycounters (month, name, value) SELECT substr(date, 1, 7), 'feerecords', COUNT(*) FROM feerecords GROUP BY substr(date, 1, 7)",
+        "INSERT INTO monthlycounters (month, name, value) SELECT substr(date, 1, 7), 'fees', SUM(depositedfee) FROM feerecords GROUP BY substr(date, 1, 7)",
+        """CREATE TRIGGER counters_students_insert AFTER INSERT ON students BEGIN
+            INSERT OR IGNORE INTO counters (name, value) VALUES ('students_' || NEW.status, 0);
+            UPDATE counters SET value=value + 1 WHERE name='students_' || NEW.status;
+        END""",
+        """CREATE TRIGGER counters_students_delete AFTER DELETE ON students BEGIN
+            UPDATE counters SET value=value - 1 WHERE name='students_' || OLD.status;
+        END""",
+        """CREATE TRIGGER counters_students_status AFTER UPDATE OF status ON students WHEN OLD.status IS NOT NEW.status BEGIN
+            UPDATE counters SET value=value - 1 WHERE name='students_' || OLD.status;
+            INSERT OR IGNORE INTO counters (name, value) VALUES ('students_' || NEW.status, 0);
+            UPDATE counters SET value=value + 1 WHERE name='students_' || NEW.status;
+        END""",
+        """CREATE TRIGGER counters_admins_insert AFTER INSERT ON admins BEGIN
+            UPDATE counters SET value=value + 1 WHERE name='admins';
+        END""",
+        """CREATE TRIGGER counters_admins_delete AFTER DELETE ON admins BEGIN
+            UPDATE counters SET value=value - 1 WHERE name='admins';
+        END""",
+        """CREATE TRIGGER counters_testrecords_insert AFTER INSERT ON testrecords BEGIN
+            UPDATE counters SET value=value + 1 WHERE name='testrecords';
+            INSERT OR IGNORE INTO monthlycounters (month, name, value) VALUES (substr(NEW.date, 1, 7), 'testrecords', 0);
+            UPDATE monthlycounters SET value=value + 1 WHERE month=substr(NEW.date, 1, 7) AND name='testrecords';
+        END""",
+        """CREATE TRIGGER counters_testrecords_delete AFTER DELETE ON testrecords BEGIN
+            UPDATE counters SET value=value - 1 WHERE name='testrecords';
+            UPDATE monthlycounters SET value=value - 1 WHERE month=substr(OLD.date, 1, 7) AND name='testrecords';
+        END""",
+        """CREATE TRIGGER counters_testrecords_date AFTER UPDATE OF date ON testrecords WHEN substr(OLD.date, 1, 7) IS NOT substr(NEW.date, 1, 7) BEGIN
+            UPDATE monthlycounters SET value=value - 1 WHERE month=substr(OLD.date, 1, 7) AND name='testrecords';
+            INSERT OR IGNORE INTO monthlycounters (month, name, value) VALUES (substr(NEW.date, 1, 7), 'testrecords', 0);
+            UPDATE monthlycounters SET value=value + 1 WHERE month=substr(NEW.date, 1, 7) AND name='testrecords';
+        END""",
+        """CREATE TRIGGER counters_feerecords_insert AFTER INSERT ON feerecords BEGIN
+            UPDATE counters SET value=value + 1 WHERE name='feerecords';
+            INSERT OR IGNORE INTO monthlycounters (month, name, value) VALUES (substr(NEW.date, 1, 7), 'feerecords', 0);
+            UPDATE monthlycounters SET value=value + 1 WHERE month=substr(NEW.date, 1, 7) AND name='feerecords';
+            INSERT OR IGNORE INTO monthlycounters (month, name, value) VALUES (substr(NEW.date, 1, 7), 'fees', 0);
+            UPDATE monthlycounters SET value=value + NEW.depositedfee WHERE month=substr(NEW.date, 1, 7) AND name='fees';
+        END""",
+        """CREATE TRIGGER counters_feerecords_delete AFTER DELETE ON feerecords BEGIN
+            UPDATE counters SET value=value - 1 WHERE name='feerecords';
+            UPDATE monthlycounters SET value=value - 1 WHERE month=substr(OLD.date, 1, 7) AND name='feerecords';
+            UPDATE monthlycounters SET value=value - OLD.depositedfee WHERE month=substr(OLD.date, 1, 7) AND name='fees';
+        END""",
+        """CREATE TRIGGER counters_feerecords_update AFTER UPDATE OF date, depositedfee ON feerecords BEGIN
+            UPDATE monthlycounters SET value=value - 1 WHERE month=substr(OLD.date, 1, 7) AND name='feerecords';
+            UPDATE monthlycounters SET value=value - OLD.depositedfee WHERE month=substr(OLD.date, 1, 7) AND name='fees';
+            INSERT OR IGNORE INTO monthlycounters (month, name, value) VALUES (substr(NEW.date, 1, 7), 'feerecords', 0);
+            UPDATE monthlycounters SET value=value + 1 WHERE month=substr(NEW.date, 1, 7) AND name='feerecords';
+            INSERT OR IGNORE INTO monthlycounters (month, name, value) VALUES (substr(NEW.date, 1, 7), 'fees', 0);
+            UPDATE monthlycounters SET value=value + NEW.depositedfee WHERE month=substr(NEW.date, 1, 7) AND name='fees';
+        END"""
+    ],
+    # 5: billing period ("YYYY-MM") of every fee record, for the outstanding dues report
+    [
+        "ALTER TABLE feerecords ADD COLUMN period TEXT",
+        backfillfeeperiods,
+        "CREATE INDEX IF NOT EXISTS idx_feerecords_studentID_period ON feerecords (studentID, period, depositedfee)"
+    ],
+    # 6: fee collection rollups by month of deposit, class of the student and admin who took the deposit,
+    #    kept up to date by triggers
+    [
+        "ALTER TABLE feerecords ADD COLUMN class TEXT",
+        "ALTER TABLE feerecords ADD COLUMN adminID INTEGER",
+        "UPDATE feerecords SET class=(SELECT class FROM students WHERE students.id=feerecords.studentID)",
+        "CREATE TABLE feerollups (month TEXT NOT NULL, class TEXT NOT NULL, adminID INTEGER NOT NULL, deposits INTEGER NOT NULL DEFAULT 0, amount INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (month, class, adminID))"
+    ] + FEEROLLUPS_REBUILD + [
+        """CREATE TRIGGER feerollups_insert AFTER INSERT ON feerecords BEGIN
+            INSERT OR IGNORE INTO feerollups (month, class, adminID) VALUES (substr(NEW.date, 1, 7), IFNULL(NEW.class, ''), IFNULL(NEW.adminID, 0));
+            UPDATE feerollups SET deposits=deposits + 1, amount=amount + NEW.depositedfee WHERE month=substr(NEW.date, 1, 7) AND class=IFNULL(NEW.class, '') AND adminID=IFNULL(NEW.adminID, 0);
+        END""",
+        """CREATE TRIGGER feerollups_delete AFTER DELETE ON feerecords BEGIN
+            UPDATE feerollups SET deposits=deposits - 1, amount=amount - OLD.depositedfee WHERE month=substr(OLD.date, 1, 7) AND class=IFNULL(OLD.class, '') AND adminID=IFNULL(OLD.adminID, 0);
+        END""",
+        """CREATE TRIGGER feerollups_update AFTER UPDATE OF date, depositedfee, class, adminID ON feerecords BEGIN
+            UPDATE feerollups SET deposits=deposits - 1, amount=amount - OLD.depositedfee WHERE month=substr(OLD.date, 1, 7) AND class=IFNULL(OLD.class, '') AND adminID=IFNULL(OLD.adminID, 0);
+            INSERT OR IGNORE INTO feerollups (month, class, adminID) VALUES (substr(NEW.date, 1, 7), IFNULL(NEW.class, ''), IFNULL(NEW.adminID, 0));
+            UPDATE feerollups SET deposits=deposits + 1, amount=amount + NEW.depositedfee WHERE month=substr(NEW.date, 1, 7) AND class=IFNULL(NEW.class, '') AND adminID=IFNULL(NEW.adminID, 0);
+        END"""
+    ],
+    # 7: content addressed image blobs, reference counted by triggers. created is when the blob was last
+    #    saved, unreferenced blobs are only collected some time after that.
+    [
+        "CREATE TABLE blobs (hash TEXT PRIMARY KEY NOT NULL, refs INTEGER NOT NULL DEFAULT 0, created INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS idx_blobs_refs ON blobs (refs, created)"
+    ] + blobtriggers("students") + blobtriggers("admins"),
+    # 8: row versions of students and admins, bumped on every update, and a version of the whole admins
+    #    table (counter "admins_version"), for the ETags of the profile and admin list endpoints
+    [
+        "ALTER TABLE students ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE admins ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+        "INSERT OR IGNORE INTO counters (name, value) VALUES ('admins_version', 0)",
+        """CREATE TRIGGER version_students_update AFTER UPDATE ON students WHEN NEW.version IS OLD.version BEGIN
+            UPDATE students SET version=version + 1 WHERE id=NEW.id;
+        END""",
+        """CREATE TRIGGER version_admins_update AFTER UPDATE ON admins WHEN NEW.version IS OLD.version BEGIN
+            UPDATE admins SET version=version + 1 WHERE id=NEW.id;
+            UPDATE counters SET value=value + 1 WHERE name='admins_version';
+        END""",
+        """CREATE TRIGGER version_admins_insert AFTER INSERT ON admins BEGIN
+            UPDATE counters SET value=value + 1 WHERE name='admins_version';
+        END""",
+        """CREATE TRIGGER version_admins_delete AFTER DELETE ON admins BEGIN
+            UPDATE counters SET value=value + 1 WHERE name='admins_version';
+        END"""
+    ],
+    # 9: server side sessions of the production app (see create_app), expires is a unix time
+    [
+        "CREATE TABLE sessions (id TEXT PRIMARY KEY NOT NULL, data TEXT NOT NULL, expires INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires)"
+    ],
+    # 10: full-text search of the students
+    [
+        studentsearchindex
+    ],
+    # 11: version of each student's test records, bumped on every change, for the analytics cache
+    [
+        "CREATE TABLE testversions (studentID INTEGER PRIMARY KEY NOT NULL, version INTEGER NOT NULL DEFAULT 0)",
+        "INSERT INTO testversions (studentID) SELECT DISTINCT studentID FROM testrecords",
+        """CREATE TRIGGER testversions_insert AFTER INSERT ON testrecords BEGIN
+            INSERT OR IGNORE INTO testversions (studentID) VALUES (NEW.studentID);
+            UPDATE testversions SET version=version + 1 WHERE studentID=NEW.studentID;
+        END""",
+        """CREATE TRIGGER testversions_delete AFTER DELETE ON testrecords BEGIN
+            UPDATE testversions SET version=version + 1 WHERE studentID=OLD.studentID;
+        END""",
+        """CREATE TRIGGER testversions_update AFTER UPDATE ON testrecords BEGIN
+            UPDATE testversions SET version=version + 1 WHERE studentID=OLD.studentID;
+            INSERT OR IGNORE INTO testversions (studentID) VALUES (NEW.studentID);
+            UPDATE testversions SET version=version + 1 WHERE studentID=NEW.studentID AND NEW.studentID IS NOT OLD.studentID;
+        END"""
+    ],
+    # 12: class reports (see classscores) read the marks from this index alone, already in group order
+    [
+        "CREATE INDEX IF NOT EXISTS idx_testrecords_report ON testrecords (class, studentID, subject, date, obtainedmarks, totalmarks)"
+    ],
+    # 13: bulk operations on students, with the value each changed student had before and after, for undo
+    [
+        "CREATE TABLE bulkoperations (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, operation TEXT NOT NULL, field TEXT NOT NULL, description TEXT NOT NULL, adminID INTEGER, created TEXT NOT NULL, students INTEGER NOT NULL DEFAULT 0, undone TEXT, restored INTEGER)",
+        "CREATE TABLE bulksnapshots (operationID INTEGER NOT NULL, studentID INTEGER NOT NULL, oldvalue, newvalue, PRIMARY KEY (operationID, studentID)) WITHOUT ROWID"
+    ],
+    # 14: billing periods again, words starting like a month ("Maybe", "Junior") were taken for months
+    [
+        backfillfeeperiods
+    ]
+]
+
+### Apply pending migrations, each in its own transaction together with its version bump
+def migrate(database):
+    connection = database.engine.raw_connection()
+    try:
+        sqlite = connection.connection
+        isolation_level = sqlite.isolation_level
+        # manage transactions manually so DDL and the version bump commit (or roll back) together
+        sqlite.isolation_level = None
+        try:
+            while True:
+                # take the write lock before reading the version so concurrent starts don't apply a migration twice
+                sqlite.execute("BEGIN IMMEDIATE")
+                try:
+                    version = sqlite.execute("PRAGMA user_version").fetchone()[0]
+                    if version >= len(MIGRATIONS):
+                        sqlite.execute("COMMIT")
+                        break
+                    for statement in MIGRATIONS[version]:
+                        if callable(statement):
+                            statement(sqlite)
+                        else:
+                            sqlite.execute(statement)
+                    sqlite.execute("PRAGMA user_version=" + str(version + 1))
+                    sqlite.execute("COMMIT")
+                except:
+                    sqlite.execute("ROLLBACK")
+                    raise
+        finally:
+            sqlite.isolation_level = isolation_level
+    finally:
+        connection.close()
+
 
 ### configure flask
 server = Flask(__name__)
@@ -93,6 +576,20 @@ def RepresentsInt(s):
     except ValueError:
         return False
 
+### JSON response with a (weak) ETag, or 304 Not Modified if the browser's copy has that ETag.
+### load is only called when the data has to be sent.
+def conditionaljson(etag, load):
+    if request.if_none_match.contains_weak(etag):
+        response = make_response("", 304)
+    else:
+        response = jsonify(load())
+    response.set_etag(etag, weak=True)
+    return response
+
+### Escape LIKE wildcards in a search term and wrap it for a substring match with ESCAPE '!'
+def like_pattern(s):
+    return "%" + s.replace("!", "!!").replace("%", "!%").replace("_", "!_") + "%"
+
 
 ### configure root directory path relative to this file
 THIS_FOLDER_G = ""
@@ -103,8 +600,44 @@ else:
     # unfrozen
     THIS_FOLDER_G = os.path.dirname(os.path.realpath(__file__))
 
+### Settings are read from config.ini next to this file (see config.example.ini),
+### an environment variable SRS_<SECTION>_<NAME> overrides the file
+config = configparser.ConfigParser()
+config.read(os.path.join(THIS_FOLDER_G, "config.ini"))
+
+def setting(section, name, default):
+    value = os.environ.get("SRS_" + section.upper() + "_" + name.upper())
+    if value is None:
+        value = config.get(section, name, fallback=None)
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    if isinstance(default, int):
+        return int(value)
+    return value
+
 ### configure CS50 Library to use SQLite database
-db = SQL("sqlite:///" + THIS_FOLDER_G + "/db/system.db")
+### Connections are checked out of a pool for each statement or transaction, by any thread, with the
+### pragmas applied once when they are opened. Requests beyond pool_size + max_overflow connections
+### wait up to pool_timeout seconds for one to be returned. WAL lets readers run alongside the writer,
+### and busy_timeout makes a writer wait for the lock instead of failing with "database is locked".
+db = SQL(
+    "sqlite:///" + os.path.join(THIS_FOLDER_G, setting("database", "path", "db/system.db")),
+    pragmas=[
+        ("busy_timeout", setting("database", "busy_timeout", 5000)),
+        ("journal_mode", setting("database", "journal_mode", "WAL")),
+        ("synchronous", setting("database", "synchronous", "NORMAL")),
+        ("cache_size", setting("database", "cache_size", -16000)),
+        ("mmap_size", setting("database", "mmap_size", 268435456)),
+        ("temp_store", "MEMORY")
+    ],
+    poolclass=sqlalchemy.pool.QueuePool,
+    pool_size=setting("database", "pool_size", 20),
+    max_overflow=setting("database", "max_overflow", 10),
+    pool_timeout=setting("database", "pool_timeout", 30),
+    connect_args={"check_same_thread": False, "timeout": setting("database", "busy_timeout", 5000) / 1000.0}
+)
 
 ### Disable cache
 @server.after_request
@@ -117,19 +650,134 @@ def add_header(r):
     r.headers["Pragma"] = "no-cache"
     r.headers["Expires"] = "0"
     r.headers['Cache-Control'] = 'public, max-age=0'
+    # the contents of a blob URL never change (see saveimage)
+    if request.path.startswith("/static/img/db/blobs/") and BLOB_IMAGE.match(request.path) is not None:
+        r.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        del r.headers["Pragma"]
+        del r.headers["Expires"]
+    # so do the asset URLs of the current build (see asseturl)
+    if request.endpoint == "asset" and request.view_args.get("build") == staticbuild() and r.status_code == 200:
+        r.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        del r.headers["Pragma"]
+        del r.headers["Expires"]
     return r
 
+### Stylesheets, scripts and fonts are linked through /assets/<build>/<path>, where build is a hash of all of
+### them, so browsers can keep them for good and fetch them again only after a file changed. Fonts are linked
+### relatively from the stylesheets, so one build hash (rather than one per file) keeps those links working.
+ASSET_FOLDERS = ["css", "js", "fonts"]
+### Compressible assets get .gz (and with the brotli package installed, .br) copies made by buildstatic
+ASSET_COMPRESSIBLE = (".css", ".js", ".svg", ".ttf", ".eot", ".otf")
+staticbuild_cache = {"build": None}
+
+def staticbuild():
+    if staticbuild_cache["build"] is None:
+        digest = hashlib.sha1()
+        for folder in ASSET_FOLDERS:
+            for root, directories, filenames in sorted(os.walk(os.path.join(server.static_folder, folder))):
+                directories.sort()
+                for filename in sorted(filenames):
+                    if filename.endswith(".gz") or filename.endswith(".br"):
+                        continue
+                    path = os.path.join(root, filename)
+                    digest.update(os.path.relpath(path, server.static_folder).replace(os.sep, "/").encode())
+                    with open(path, "rb") as f:
+                        digest.update(f.read())
+        staticbuild_cache["build"] = digest.hexdigest()[:12]
+    return staticbuild_cache["build"]
+
+### URL of a static file for templates: {{ asseturl("css/main.css") }}
+def asseturl(filename):
+    if filename.split("/")[0] in ASSET_FOLDERS:
+        return "/assets/" + staticbuild() + "/" + filename
+    return "/static/" + filename
+
+server.jinja_env.globals["asseturl"] = asseturl
+
+### Serve an asset, or its precompressed copy when the browser accepts it
+@server.route("/assets/<build>/<path:filename>")
+def asset(build, filename):
+    if filename.split("/")[0] not in ASSET_FOLDERS:
+        return render_template("notfound.html", msg="File Not Found."), 404
+    for encoding, extension in (("br", ".br"), ("gzip", ".gz")):
+        if request.accept_encodings[encoding] > 0 and os.path.isfile(os.path.join(server.static_folder, filename + extension)):
+            response = send_from_directory(server.static_folder, filename + extension, mimetype=mimetypes.guess_type(filename)[0])
+            response.headers["Content-Encoding"] = encoding
+            response.headers["Vary"] = "Accept-Encoding"
+            return response
+    return send_from_directory(server.static_folder, filename)
+
+### Write .gz/.br copies of the compressible assets that are missing or older than the asset.
+### Folders that can't be written to (e.g. an installed executable) are skipped, those assets
+### are then compressed on the fly.
+def buildstatic():
+    compressors = [(".gz", lambda data: gzip.compress(data, 9))]
+    if brotli is not None:
+        compressors.append((".br", brotli.compress))
+    built = 0
+    for folder in ASSET_FOLDERS:
+        for root, directories, filenames in os.walk(os.path.join(server.static_folder, folder)):
+            for filename in filenames:
+                if not filename.endswith(ASSET_COMPRESSIBLE):
+                    continue
+                path = os.path.join(root, filename)
+                data = None
+                for extension, compress in compressors:
+                    if os.path.isfile(path + extension) and os.path.getmtime(path + extension) >= os.path.getmtime(path):
+                        continue
+                    try:
+                        if data is None:
+                            with open(path, "rb") as f:
+                                data = f.read()
+                        with open(path + extension + ".tmp", "wb") as f:
+                            f.write(compress(data))
+                        os.replace(path + extension + ".tmp", path + extension)
+                        built += 1
+                    except (IOError, OSError):
+                        pass
+    return built
+
+### Precompress the static assets: FLASK_APP=server.py flask build-static
+@server.cli.command("build-static")
+def buildstaticcommand():
+    click.echo(str(buildstatic()) + " compressed assets written.")
+
+### In-process copy of the system settings. Saves made by other processes are picked up through
+### the version column, which is checked at most once every check_interval seconds.
+systemsettings_cache = {"settings": None, "version": None, "checked": 0}
+systemsettings_lock = threading.Lock()
+SYSTEMSETTINGS_CHECK_INTERVAL = setting("systemsettings", "check_interval", 5)
+
+def loadsystemsettings():
+    systemsettings = db.execute("SELECT * FROM systemsettings WHERE id=:id", id=1)
+    settings = {}
+    settings["institutionname"] = systemsettings[0]["institutionname"]
+    settings["icoURL"] = systemsettings[0]["icoURL"]
+    settings["pngURL"] = systemsettings[0]["pngURL"]
+    settings["jpgURL"] = systemsettings[0]["jpgURL"]
+    settings["nameinheader"] = systemsettings[0]["nameinheader"]
+    settings["logoinheader"] = systemsettings[0]["logoinheader"]
+    systemsettings_cache["settings"] = settings
+    systemsettings_cache["version"] = systemsettings[0]["version"]
+    systemsettings_cache["checked"] = time.time()
+
+def cachedsystemsettings():
+    if systemsettings_cache["settings"] is None or time.time() - systemsettings_cache["checked"] >= SYSTEMSETTINGS_CHECK_INTERVAL:
+        with systemsettings_lock:
+            if systemsettings_cache["settings"] is None:
+                loadsystemsettings()
+            elif time.time() - systemsettings_cache["checked"] >= SYSTEMSETTINGS_CHECK_INTERVAL:
+                version = db.execute("SELECT version FROM systemsettings WHERE id=:id", id=1)
+                if version[0]["version"] != systemsettings_cache["version"]:
+                    loadsystemsettings()
+                else:
+                    systemsettings_cache["checked"] = time.time()
+    return systemsettings_cache["settings"]
+
 ### Store current session to global variable "g"
 @server.before_request
 def before_request():
-    g.systemsettings = {}
-    systemsettings = db.execute("SELECT * FROM systemsettings WHERE id=:id", id=1)
-    g.systemsettings["institutionname"] = systemsettings[0]["institutionname"]
-    g.systemsettings["icoURL"] = systemsettings[0]["icoURL"]
-    g.systemsettings["pngURL"] = systemsettings[0]["pngURL"]
-    g.systemsettings["jpgURL"] = systemsettings[0]["jpgURL"]
-    g.systemsettings["nameinheader"] = systemsettings[0]["nameinheader"]
-    g.systemsettings["logoinheader"] = systemsettings[0]["logoinheader"]
+    g.systemsettings = dict(cachedsystemsettings())
 
     g.user = None
     g.firstname = None
@@ -158,17 +806,232 @@ def index():
     else:
         return redirect(url_for("login"))
 
+### Dashboard figures read from the trigger-maintained counters (see migration 4)
+def dashboardstats():
+    stats = {"students_Active": 0, "students_Inactive": 0, "admins": 0, "testrecords": 0, "feerecords": 0}
+    for counter in db.execute("SELECT name, value FROM counters"):
+        stats[counter["name"]] = counter["value"]
+    month = time.strftime("%Y-%m")
+    stats["testrecords_month"] = 0
+    stats["feerecords_month"] = 0
+    stats["fees_month"] = 0
+    for counter in db.execute("SELECT name, value FROM monthlycounters WHERE month=:month", month=month):
+        stats[counter["name"] + "_month"] = counter["value"]
+    return stats
+
 ### Home
 @server.route("/home")
 def home():
     if g.user:
-        numofstudents = len(db.execute("SELECT * FROM students WHERE status=:status", status="Active"))
-        numofadmins = len(db.execute("SELECT * FROM admins"))
-        return render_template("home.html", numofstudents=numofstudents, numofadmins=(numofadmins - 1))
+        stats = dashboardstats()
+        return render_template("home.html", numofstudents=stats["students_Active"], numofadmins=(stats["admins"] - 1), stats=stats)
     else:
         return redirect(url_for("login"))
 
 
+'''
+    Images
+'''
+### Uploaded photos are decoded, turned upright, stripped of metadata and saved as JPEG variants: the photo
+### (at most 800px), a card (256px square, ID cards and profiles) and a thumbnail (96px square, lists).
+### They are kept in a content addressed store, static/img/db/blobs/ab/cd/abcd<rest of the sha1 of the photo>.jpg
+### with the _card and _thumb variants next to it. Identical photos are stored once and a URL never changes
+### content, so the files can be cached for good. Blobs are reference counted by triggers on the imgURL of
+### students and admins (migration 7), unreferenced blobs are deleted by collectblobs in the background.
+IMAGE_VARIANTS = {"": (800, False), "card": (256, True), "thumb": (96, True)}
+IMAGE_QUALITY = setting("images", "quality", 85)
+Image.MAX_IMAGE_PIXELS = setting("images", "max_pixels", 40000000)
+BLOBS_DIRECTORY = os.path.join(THIS_FOLDER_G, "static", "img", "db", "blobs")
+BLOB_IMAGE = re.compile(r"^(.*/blobs/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{40})(_[a-z]+)?\.jpg$")
+### Unreferenced blobs are kept for grace_period seconds after they were saved, an upload is referenced
+### only after its blob is saved
+BLOBS_GRACE_PERIOD = setting("images", "grace_period", 3600)
+BLOBS_COLLECT_INTERVAL = setting("images", "collect_interval", 3600)
+
+### Decode an uploaded image (bytes) into the JPEG bytes of each variant. Raises ValueError if it isn't a usable image
+def processimage(data):
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        image = ImageOps.exif_transpose(image)
+    except (IOError, OSError, SyntaxError, Image.DecompressionBombError):
+        raise ValueError("Invalid image.")
+
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[3])
+        image = background
+    else:
+        image = image.convert("RGB")
+
+    variants = {}
+    for variant, (size, square) in IMAGE_VARIANTS.items():
+        if square:
+            resized = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        else:
+            resized = image.copy()
+            resized.thumbnail((size, size), Image.LANCZOS)
+        output = io.BytesIO()
+        resized.save(output, "JPEG", quality=IMAGE_QUALITY, optimize=True)
+        variants[variant] = output.getvalue()
+    return variants
+
+### File path of a blob variant
+def blobpath(hash, variant=""):
+    return os.path.join(BLOBS_DIRECTORY, hash[:2], hash[2:4], hash + ("_" + variant if variant != "" else "") + ".jpg")
+
+### Save the variants from processimage in the blob store, returns the URL to store in imgURL.
+### Pass the transaction when called inside one.
+def saveimage(variants, transaction=None):
+    if transaction is None:
+        with db.transaction() as transaction:
+            return saveimage(variants, transaction)
+
+    hash = hashlib.sha1(variants[""]).hexdigest()
+    # the blob is registered (or its grace period restarted) before its files are written,
+    # collectblobs deletes files only while it holds the write lock
+    transaction.execute("INSERT OR IGNORE INTO blobs (hash, refs, created) VALUES (:hash, 0, :created)", hash=hash, created=int(time.time()))
+    transaction.execute("UPDATE blobs SET created=:created WHERE hash=:hash", hash=hash, created=int(time.time()))
+    for variant, content in variants.items():
+        path = blobpath(hash, variant)
+        if os.path.exists(path):
+            continue
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        temp = path + "." + uuid.uuid4().hex + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(content)
+        os.replace(temp, path)
+    return "../static/img/db/blobs/" + hash[:2] + "/" + hash[2:4] + "/" + hash + ".jpg"
+
+### URL of a variant ("card", "thumb") of a saved photo. Photos saved before the blob store,
+### and the default picture, are their own variants.
+def imagevariant(url, variant):
+    match = BLOB_IMAGE.match(url or "")
+    if match is None or match.group(2) is not None:
+        return url
+    return match.group(1) + "_" + variant + ".jpg"
+
+### Add the card and thumbnail URLs to rows with an imgURL
+def withimagevariants(rows):
+    for row in rows:
+        row["cardURL"] = imagevariant(row["imgURL"], "card")
+        row["thumbURL"] = imagevariant(row["imgURL"], "thumb")
+    return rows
+
+### File path of an image stored as a "../static/..." URL
+def imagepath(url):
+    return os.path.join(THIS_FOLDER_G, url[3:] if url.startswith("../") else url)
+
+### Photo files under the fixed names used before the blob store (student_3.jpg, admin_1.png)
+LEGACY_IMAGE = re.compile(r"^(student|admin)_\d+(\.[A-Za-z]+|_[0-9a-f]{12}(_[a-z]+)?\.jpg)$")
+
+### Delete blobs without references whose grace period is over, and photo files under the old
+### fixed names that no student or admin refers to any more. Returns the number of blobs deleted
+def collectblobs():
+    cutoff = int(time.time()) - BLOBS_GRACE_PERIOD
+    with db.transaction() as transaction:
+        orphans = transaction.execute("SELECT hash FROM blobs WHERE refs<=0 AND created<:cutoff", cutoff=cutoff)
+        for blob in orphans:
+            for variant in IMAGE_VARIANTS:
+                try:
+                    os.remove(blobpath(blob["hash"], variant))
+                except OSError:
+                    pass
+        transaction.executemany("DELETE FROM blobs WHERE hash=:hash", orphans)
+
+    for table in ("students", "admins"):
+        referenced = set(row["imgURL"] for row in db.execute("SELECT imgURL FROM " + table + " WHERE imgURL LIKE :url", url="../static/img/db/" + table + "/%"))
+        directory = os.path.join(THIS_FOLDER_G, "static", "img", "db", table)
+        for filename in os.listdir(directory):
+            path = os.path.join(directory, filename)
+            if LEGACY_IMAGE.match(filename) and "../static/img/db/" + table + "/" + filename not in referenced and os.path.getmtime(path) < cutoff:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+    return len(orphans)
+
+blobcollector = {"thread": None}
+
+def blobcollectorloop():
+    while True:
+        time.sleep(BLOBS_COLLECT_INTERVAL)
+        try:
+            collectblobs()
+        except (RuntimeError, OSError):
+            # database busy or a directory unreadable, try again next time
+            pass
+
+### Start collecting blobs in the background once the server is serving
+@server.before_first_request
+def startblobcollector():
+    if BLOBS_COLLECT_INTERVAL > 0 and blobcollector["thread"] is None:
+        blobcollector["thread"] = threading.Thread(target=blobcollectorloop, name="blobcollector")
+        blobcollector["thread"].daemon = True
+        blobcollector["thread"].start()
+
+### Move photos saved before the blob store into it: FLASK_APP=server.py flask process-images
+@server.cli.command("process-images")
+def processimagescommand():
+    migrate(db)
+    for table in ("students", "admins"):
+        for row in db.execute("SELECT id, imgURL FROM " + table + " WHERE imgURL LIKE :url", url="../static/img/db/" + table + "/%"):
+            try:
+                with open(imagepath(row["imgURL"]), "rb") as f:
+                    imgURL = saveimage(processimage(f.read()))
+            except (IOError, OSError, ValueError) as error:
+                click.echo(row["imgURL"] + ": " + str(error), err=True)
+                continue
+            db.execute("UPDATE " + table + " SET imgURL=:imgURL WHERE id=:id", imgURL=imgURL, id=row["id"])
+            click.echo(row["imgURL"] + " -> " + imgURL)
+
+### Recount blob references and delete unreferenced blobs now: FLASK_APP=server.py flask collect-blobs
+@server.cli.command("collect-blobs")
+def collectblobscommand():
+    migrate(db)
+    db.execute(BLOBS_RECOUNT)
+    click.echo(str(collectblobs()) + " unreferenced images deleted.")
+
+
+'''
+    Passwords
+'''
+### Hashes are computed in their own process pool, so logins neither hold the GIL on the request
+### threads nor queue behind print jobs. The scheme and rounds of new hashes are configurable,
+### stored hashes are upgraded to them at login (see passwords.py).
+PASSWORD_SCHEME = setting("passwords", "scheme", "sha256_crypt")
+PASSWORD_ROUNDS = setting("passwords", "rounds", 0)
+passwordpool = {"executor": None}
+passwordpool_lock = threading.Lock()
+
+def passwordexecutor():
+    with passwordpool_lock:
+        if passwordpool["executor"] is None:
+            passwordpool["executor"] = concurrent.futures.ProcessPoolExecutor(max_workers=setting("passwords", "workers", 2), mp_context=multiprocessing.get_context("spawn"))
+        return passwordpool["executor"]
+
+### Run a passwords.py function in the pool, or in this process if the pool has died
+def passwordjob(function, *args):
+    try:
+        return passwordexecutor().submit(function, *args, PASSWORD_SCHEME, PASSWORD_ROUNDS).result()
+    except concurrent.futures.process.BrokenProcessPool:
+        with passwordpool_lock:
+            passwordpool["executor"] = None
+        return function(*args, PASSWORD_SCHEME, PASSWORD_ROUNDS)
+
+def hashpassword(password):
+    return passwordjob(passwords.hash, password)
+
+### Check a password against an admin row, replacing its hash if it uses an outdated scheme or rounds
+def checkpassword(password, admin):
+    matched, newhash = passwordjob(passwords.verify, password, admin["password"])
+    if matched and newhash is not None:
+        db.execute("UPDATE admins SET password=:password WHERE id=:id AND password=:old", password=newhash, id=admin["id"], old=admin["password"])
+    return matched
+
+
 '''
     Login/Logout
 '''
@@ -182,7 +1045,7 @@ def login():
         password = request.form["password"]
         users = db.execute("SELECT * FROM admins WHERE username=:username", username=username)
         if len(users) > 0:
-            if users[0]["username"] == username and sha256_crypt.verify(password, users[0]["password"]) == True:
+            if users[0]["username"] == username and checkpassword(password, users[0]) == True:
                 session.pop("user", None)
                 session.pop("username", None)
                 session.pop("firstname", None)
@@ -216,6 +1079,9 @@ def logout():
 '''
     Administrators
 '''
+### Columns of an admin sent to the browser, all but the password hash
+ADMIN_COLUMNS = "id, username, firstname, lastname, role, contact, imgURL, version"
+
 ### Main administrators page
 @server.route("/administrators")
 def administrators():
@@ -228,13 +1094,18 @@ def administrators():
 @server.route("/getadmins", methods=["GET", "POST"])
 def getadmins():
     if g.user and g.role == "root":
-        admins = db.execute("SELECT * FROM admins")
-        admins = sorted(admins, key=lambda k: str.lower(k["firstname"]))
-        for i in range(len(admins)):
-            if admins[i]["username"] == g.username:
-                admins.pop(i)
-                break
-        return jsonify(admins)
+        version = db.execute("SELECT value FROM counters WHERE name='admins_version'")[0]["value"]
+
+        def load():
+            admins = db.execute("SELECT " + ADMIN_COLUMNS + " FROM admins")
+            admins = sorted(admins, key=lambda k: str.lower(k["firstname"]))
+            for i in range(len(admins)):
+                if admins[i]["username"] == g.username:
+                    admins.pop(i)
+                    break
+            return withimagevariants(admins)
+
+        return conditionaljson("admins-" + str(version) + "-" + str(g.user), load)
     else:
         return redirect(url_for("home"))
 
@@ -258,33 +1129,21 @@ def saveadmininfo():
                 if admins[i]["username"] == username and admins[i]["id"] != int(id):
                     return jsonify([{"status": "error", "msg": "Username already taken."}])
 
+            values = {"firstname": firstname, "lastname": lastname, "username": username, "contact": contact, "role": role}
+
             if image:
                 if allowed_file(image.filename) == True:
-                    imagename = image.filename
-                    imageext = imagename.split(".")[-1]
-                    imagename = "admin_" + str(id) + "." + imageext
-                    imgExt = db.execute("SELECT * FROM admins WHERE id=:id", id=int(id))
-                    imgExt = imgExt[0]["imgURL"]
-                    imgExt = imgExt.split(".")
-                    imgExt = imgExt[-1]
                     try:
-                        os.remove(os.path.join(THIS_FOLDER_G + "/static/img/db/admins/", "admin_" + id + "." + imgExt))
-                    except:
-                        pass
-                    image.save(os.path.join(THIS_FOLDER_G + "/static/img/db/admins/", imagename))
-                    imgURL = "../static/img/db/admins/" + imagename
-                    db.execute("UPDATE admins SET imgURL=:imgURL WHERE id=:id", imgURL=imgURL, id=int(id))
+                        values["imgURL"] = saveimage(processimage(image.read()))
+                    except ValueError as error:
+                        return jsonify([{"status": "error", "msg": str(error)}])
                 else:
                     return jsonify([{"status": "error", "msg": "File extension not supported."}])
 
-            db.execute("UPDATE admins SET firstname=:firstname WHERE id=:id", firstname=firstname, id=int(id))
-            db.execute("UPDATE admins SET lastname=:lastname WHERE id=:id", lastname=lastname, id=int(id))
-            db.execute("UPDATE admins SET username=:username WHERE id=:id", username=username, id=int(id))
-            db.execute("UPDATE admins SET contact=:contact WHERE id=:id", contact=contact, id=int(id))
-            db.execute("UPDATE admins SET role=:role WHERE id=:id", role=role, id=int(id))
-
             if password != "":
-                db.execute("UPDATE admins SET password=:password WHERE id=:id", password=sha256_crypt.hash(password), id=int(id))
+                values["password"] = hashpassword(password)
+
+            db.update("admins", int(id), values)
 
             return jsonify([{"status": "success", "msg": "Changes saved."}])
     else:
@@ -316,19 +1175,19 @@ def addnewadmin():
             imgURL = "../static/img/system/default-prof-img.png"
             if image:
                 if allowed_file(image.filename) == True:
-                    db.execute("INSERT INTO admins (username, firstname, lastname, password, role, contact, imgURL) VALUES (:username, :firstname, :lastname, :password, :role, :contact, :imgURL)", username=username, firstname=firstname, lastname=lastname, password=sha256_crypt.hash(password), role=role, contact=contact, imgURL=imgURL)
+                    try:
+                        variants = processimage(image.read())
+                    except ValueError as error:
+                        return jsonify([{"status": "error", "msg": str(error)}])
+                    db.execute("INSERT INTO admins (username, firstname, lastname, password, role, contact, imgURL) VALUES (:username, :firstname, :lastname, :password, :role, :contact, :imgURL)", username=username, firstname=firstname, lastname=lastname, password=hashpassword(password), role=role, contact=contact, imgURL=imgURL)
                     newuser = db.execute("SELECT * FROM admins WHERE username=:username", username=username)
 
-                    imagename = image.filename
-                    imageext = imagename.split(".")[-1]
-                    imagename = "admin_" + str(newuser[0]["id"]) + "." + imageext
-                    image.save(os.path.join(THIS_FOLDER_G + "/static/img/db/admins/", imagename))
-                    imgURL = "../static/img/db/admins/" + imagename
+                    imgURL = saveimage(variants)
                     db.execute("UPDATE admins SET imgURL=:imgURL WHERE id=:id", imgURL=imgURL, id=newuser[0]["id"])
                 else:
                     return jsonify([{"status": "error", "msg": "File extension not supported."}])
             else:
-                db.execute("INSERT INTO admins (username, firstname, lastname, password, role, contact, imgURL) VALUES (:username, :firstname, :lastname, :password, :role, :contact, :imgURL)", username=username, firstname=firstname, lastname=lastname, password=sha256_crypt.hash(password), role=role, contact=contact, imgURL=imgURL)
+                db.execute("INSERT INTO admins (username, firstname, lastname, password, role, contact, imgURL) VALUES (:username, :firstname, :lastname, :password, :role, :contact, :imgURL)", username=username, firstname=firstname, lastname=lastname, password=hashpassword(password), role=role, contact=contact, imgURL=imgURL)
 
             return jsonify([{"status": "success", "msg": "Changes saved."}])
     else:
@@ -347,13 +1206,6 @@ def deleteadmin():
                 if admins[i]["id"] == int(id):
                     firstname = admins[i]["firstname"]
                     lastname = admins[i]["lastname"]
-                    imgExt = admins[i]["imgURL"]
-                    imgExt = imgExt.split(".")
-                    imgExt = imgExt[-1]
-                    try:
-                        os.remove(os.path.join(THIS_FOLDER_G + "/static/img/db/admins/", "admin_" + id + "." + imgExt))
-                    except:
-                        pass
                     db.execute("DELETE FROM admins WHERE id=:id", id=int(id))
                     return jsonify([{"status": "success", "msg": "Deleted", "firstname": firstname, "lastname": lastname}])
     else:
@@ -367,16 +1219,22 @@ def deleteadmin():
 @server.route("/userprofile", methods=["GET", "POST"])
 def userprofile():
     if g.user:
-        return render_template("userprofile.html")
+        return render_template("userprofile.html", pagedata=userprofiledata())
     else:
         return redirect(url_for("home"))
 
+### Currently logged in user's data, embedded in the user profile page and sent by /getuserprofile
+def userprofiledata():
+    return withimagevariants(db.execute("SELECT " + ADMIN_COLUMNS + " FROM admins where id=:id", id=int(g.user)))
+
 ### Get currently logged in user's data via ajax to view on user profile
 @server.route("/getuserprofile", methods=["GET", "POST"])
 def getuserprofile():
     if g.user:
-        user = db.execute("SELECT * FROM admins where id=:id", id=int(g.user))
-        return jsonify(user)
+        version = db.execute("SELECT version FROM admins WHERE id=:id", id=int(g.user))
+        if len(version) < 1:
+            return jsonify([])
+        return conditionaljson("admin-" + str(g.user) + "-" + str(version[0]["version"]), userprofiledata)
     else:
         return redirect(url_for("home"))
 
@@ -403,38 +1261,27 @@ def saveuserprofile():
 
             users = db.execute("SELECT * FROM admins WHERE id=:id", id=int(g.user))
 
+            values = {"firstname": firstname, "lastname": lastname, "username": username, "contact": contact}
+
             if password != "":
                 if password != confirmpassword:
                     return jsonify([{"status": "error", "msg": "Confirm new password."}])
 
-                if sha256_crypt.verify(oldpassword, users[0]["password"]) == True:
-                    db.execute("UPDATE admins SET password=:password WHERE id=:id", password=sha256_crypt.hash(password), id=int(id))
+                if checkpassword(oldpassword, users[0]) == True:
+                    values["password"] = hashpassword(password)
                 else:
                     return jsonify([{"status": "error", "msg": "Old password did not match."}])
 
             if image:
                 if allowed_file(image.filename) == True:
-                    imagename = image.filename
-                    imageext = imagename.split(".")[-1]
-                    imagename = "admin_" + str(id) + "." + imageext
-                    imgExt = db.execute("SELECT * FROM admins WHERE id=:id", id=int(id))
-                    imgExt = imgExt[0]["imgURL"]
-                    imgExt = imgExt.split(".")
-                    imgExt = imgExt[-1]
                     try:
-                        os.remove(os.path.join(THIS_FOLDER_G + "/static/img/db/admins/", "admin_" + id + "." + imgExt))
-                    except:
-                        pass
-                    image.save(os.path.join(THIS_FOLDER_G + "/static/img/db/admins/", imagename))
-                    imgURL = "../static/img/db/admins/" + imagename
-                    db.execute("UPDATE admins SET imgURL=:imgURL WHERE id=:id", imgURL=imgURL, id=int(id))
+                        values["imgURL"] = saveimage(processimage(image.read()))
+                    except ValueError as error:
+                        return jsonify([{"status": "error", "msg": str(error)}])
                 else:
                     return jsonify([{"status": "error", "msg": "File extension not supported."}])
 
-            db.execute("UPDATE admins SET firstname=:firstname WHERE id=:id", firstname=firstname, id=int(id))
-            db.execute("UPDATE admins SET lastname=:lastname WHERE id=:id", lastname=lastname, id=int(id))
-            db.execute("UPDATE admins SET username=:username WHERE id=:id", username=username, id=int(id))
-            db.execute("UPDATE admins SET contact=:contact WHERE id=:id", contact=contact, id=int(id))
+            db.update("admins", int(id), values)
 
             users = db.execute("SELECT * FROM admins WHERE id=:id", id=int(g.user))
 
@@ -456,9 +1303,7 @@ def saveuserprofile():
 @server.route("/students")
 def students():
     if g.user:
-        students = db.execute("SELECT * FROM students WHERE status=:status", status="Active")
-        students = sorted(students, key=lambda k: str.lower(k["firstname"]))
-        return render_template("students.html", students=students)
+        return render_template("students.html")
     else:
         return redirect(url_for("home"))
 
@@ -466,12 +1311,131 @@ def students():
 @server.route("/students/inactive")
 def inactivestudents():
     if g.user:
-        students = db.execute("SELECT * FROM students WHERE status=:status", status="Inactive")
-        students = sorted(students, key=lambda k: str.lower(k["firstname"]))
-        return render_template("students.html", students=students, inactive=True)
+        return render_template("students.html", inactive=True)
+    else:
+        return redirect(url_for("home"))
+
+### Sortable columns of the students table, indexed the same as the columns in students.html
+STUDENTS_ORDER_COLUMNS = {
+    0: "id",
+    2: "firstname COLLATE NOCASE, lastname COLLATE NOCASE",
+    3: "fathername COLLATE NOCASE",
+    4: "class COLLATE NOCASE"
+}
+
+### Get a page of students via ajax for DataTables' server-side processing mode
+@server.route("/getstudents", methods=["GET", "POST"])
+def getstudents():
+    if g.user:
+        status = request.values.get("status", "Active")
+        draw = request.values.get("draw", "0")
+        start = request.values.get("start", "0")
+        length = request.values.get("length", "10")
+        search = request.values.get("search[value]", "").strip()
+        ordercolumn = request.values.get("order[0][column]", "2")
+        orderdir = request.values.get("order[0][dir]", "asc")
+
+        if status != "Active" and status != "Inactive":
+            return jsonify([{"status": "error", "msg": "Invalid status."}])
+        if RepresentsInt(draw) != True or RepresentsInt(start) != True or RepresentsInt(length) != True or RepresentsInt(ordercolumn) != True:
+            return jsonify([{"status": "error", "msg": "Incompatible data."}])
+
+        start = max(int(start), 0)
+        length = int(length)
+        if length < 1 or length > 100:
+            length = 100
+        orderby = STUDENTS_ORDER_COLUMNS.get(int(ordercolumn), STUDENTS_ORDER_COLUMNS[2])
+        orderdir = "DESC" if orderdir == "desc" else "ASC"
+        orderby = ", ".join(column + " " + orderdir for column in orderby.split(", ")) + ", id " + orderdir
+
+        where = "status=:status"
+        params = {"status": status}
+        if search != "":
+            where += " AND (firstname || ' ' || lastname LIKE :search ESCAPE '!' OR fathername LIKE :search ESCAPE '!' OR class LIKE :search ESCAPE '!'"
+            params["search"] = like_pattern(search)
+            if RepresentsInt(search) == True:
+                where += " OR id=:searchid"
+                params["searchid"] = int(search)
+            where += ")"
+
+        total = db.execute("SELECT COUNT(*) AS total FROM students WHERE status=:status", status=status)[0]["total"]
+        if search != "":
+            filtered = db.execute("SELECT COUNT(*) AS total FROM students WHERE " + where, **params)[0]["total"]
+        else:
+            filtered = total
+        students = db.execute("SELECT id, firstname, lastname, fathername, class, imgURL FROM students WHERE " + where + " ORDER BY " + orderby + " LIMIT :limit OFFSET :offset", limit=length, offset=start, **params)
+
+        return jsonify({"draw": int(draw), "recordsTotal": total, "recordsFiltered": filtered, "data": withimagevariants(students)})
+    else:
+        return redirect(url_for("home"))
+
+### Whether the students have a full-text index, see studentsearchindex
+studentsearch = {"fts": None}
+
+def studentsfts():
+    if studentsearch["fts"] is None:
+        studentsearch["fts"] = len(db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='students_fts'")) > 0
+    return studentsearch["fts"]
+
+STUDENTS_SEARCH_LIMIT = 50
+
+### Students matching every word of q as a prefix of a name, contact, address or class, best first, for the
+### student search boxes. A numeric q also finds the student with that ID. Values: q, limit, status (optional)
+@server.route("/searchstudents", methods=["GET", "POST"])
+def searchstudents():
+    if g.user:
+        q = request.values.get("q", "").strip()
+        limit = request.values.get("limit", "10")
+        status = request.values.get("status", "")
+
+        if RepresentsInt(limit) != True or status not in ("", "Active", "Inactive"):
+            return jsonify([{"status": "error", "msg": "Incompatible data."}])
+
+        limit = min(max(int(limit), 1), STUDENTS_SEARCH_LIMIT)
+        words = re.findall(r"\w+", q)
+        if len(words) < 1:
+            return jsonify([])
+
+        columns = "students.id, students.firstname, students.lastname, students.fathername, students.class, students.status, students.imgURL"
+        where = ""
+        params = {}
+        if status != "":
+            where = " AND students.status=:status"
+            params["status"] = status
+
+        students = []
+        if RepresentsInt(q) == True:
+            students = db.execute("SELECT " + columns + " FROM students WHERE id=:id" + where, id=int(q), **params)
+
+        if studentsfts():
+            matches = db.execute("SELECT " + columns + " FROM students_fts JOIN students ON students.id=students_fts.rowid WHERE students_fts MATCH :query" + where + " ORDER BY students_fts.rank LIMIT :limit",
+                                 query=" ".join('"' + word + '"*' for word in words), limit=limit, **params)
+        else:
+            # the same word prefixes the index matches: the text of the indexed columns, split into words
+            # on spaces and the punctuation common in contacts and addresses, has a word starting with each
+            text = "' ' || " + " || ' ' || ".join("IFNULL(" + column + ", '')" for column in STUDENTS_FTS_COLUMNS)
+            for separator in STUDENTS_SEARCH_SEPARATORS:
+                text = "REPLACE(" + text + ", '" + separator + "', ' ')"
+            for i in range(len(words)):
+                where += " AND (" + text + " LIKE :word" + str(i) + " ESCAPE '!')"
+                params["word" + str(i)] = "% " + like_pattern(words[i])[1:]
+            matches = db.execute("SELECT " + columns + " FROM students WHERE 1" + where + " ORDER BY firstname COLLATE NOCASE, lastname COLLATE NOCASE LIMIT :limit", limit=limit, **params)
+
+        students += [student for student in matches if len(students) < 1 or student["id"] != students[0]["id"]]
+        return jsonify(withimagevariants(students[:limit]))
     else:
         return redirect(url_for("home"))
 
+### Rebuild the student search index: FLASK_APP=server.py flask rebuild-search
+@server.cli.command("rebuild-search")
+def rebuildsearchcommand():
+    migrate(db)
+    if studentsfts():
+        db.execute("INSERT INTO students_fts (students_fts) VALUES ('rebuild')")
+        click.echo("Student search index rebuilt.")
+    else:
+        click.echo("This SQLite build has no FTS5, students are searched without an index.", err=True)
+
 ### View th profile of a specific student based on student ID
 @server.route("/studentprofile/<id>")
 def studentprofile(id):
@@ -479,9 +1443,9 @@ def studentprofile(id):
         student = db.execute("SELECT * FROM students WHERE id=:id", id=int(id))
         if len(student) > 0:
             if student[0]["status"] == "Inactive":
-                return render_template("studentprofile.html", student=student[0], inactive=True)
+                return render_template("studentprofile.html", student=student[0], inactive=True, pagedata=withimagevariants(student))
             else:
-                return render_template("studentprofile.html", student=student[0])
+                return render_template("studentprofile.html", student=student[0], pagedata=withimagevariants(student))
         else:
             return render_template("notfound.html", msg="Student Not Found.")
     else:
@@ -491,9 +1455,9 @@ def studentprofile(id):
 @server.route("/getstudentprofile/<id>")
 def getstudentprofile(id):
     if g.user:
-        student = db.execute("SELECT * FROM students WHERE id=:id", id=int(id))
-        if len(student) > 0:
-            return jsonify(student)
+        version = db.execute("SELECT version FROM students WHERE id=:id", id=int(id))
+        if len(version) > 0:
+            return conditionaljson("student-" + str(int(id)) + "-" + str(version[0]["version"]), lambda: withimagevariants(db.execute("SELECT * FROM students WHERE id=:id", id=int(id))))
         else:
             return render_template("notfound.html", msg="Student Not Found.")
     else:
@@ -529,123 +1493,475 @@ def savestudentinfo(id):
             if status != "Active" and status != "Inactive":
                 return jsonify([{"status": "error", "msg": "Invalid status."}])
 
+            if RepresentsInt(monthlyfee) != True:
+                return jsonify([{"status": "error", "msg": "Incompatible Details."}])
+
+            values = {"firstname": firstname, "lastname": lastname, "fathername": fathername, "contact": contact, "gender": gender, "dob": dob, "address": address, "class": class_, "admissiondate": admissiondate, "monthlyfee": int(monthlyfee), "status": status}
+
             if image:
                 if allowed_file(image.filename) == True:
-                    imagename = image.filename
-                    imageext = imagename.split(".")[-1]
-                    imagename = "student_" + str(id) + "." + imageext
-                    imgExt = db.execute("SELECT * FROM students WHERE id=:id", id=int(id))
-                    imgExt = imgExt[0]["imgURL"]
-                    imgExt = imgExt.split(".")
-                    imgExt = imgExt[-1]
                     try:
-                        os.remove(os.path.join(THIS_FOLDER_G + "/static/img/db/students/", "student_" + id + "." + imgExt))
-                    except:
-                        pass
-                    image.save(os.path.join(THIS_FOLDER_G + "/static/img/db/students/", imagename))
-                    imgURL = "../static/img/db/students/" + imagename
-                    db.execute("UPDATE students SET imgURL=:imgURL WHERE id=:id", imgURL=imgURL, id=int(id))
+                        values["imgURL"] = saveimage(processimage(image.read()))
+                    except ValueError as error:
+                        return jsonify([{"status": "error", "msg": str(error)}])
                 else:
                     return jsonify([{"status": "error", "msg": "File extension not supported."}])
 
-            db.execute("UPDATE students SET firstname=:firstname WHERE id=:id", firstname=firstname, id=int(id))
-            db.execute("UPDATE students SET lastname=:lastname WHERE id=:id", lastname=lastname, id=int(id))
-            db.execute("UPDATE students SET fathername=:fathername WHERE id=:id", fathername=fathername, id=int(id))
-            db.execute("UPDATE students SET contact=:contact WHERE id=:id", contact=contact, id=int(id))
-            db.execute("UPDATE students SET gender=:gender WHERE id=:id", gender=gender, id=int(id))
-            db.execute("UPDATE students SET dob=:dob WHERE id=:id", dob=dob, id=int(id))
-            db.execute("UPDATE students SET address=:address WHERE id=:id", address=address, id=int(id))
-            db.execute("UPDATE students SET class=:class_ WHERE id=:id", class_=class_, id=int(id))
-            db.execute("UPDATE students SET admissiondate=:admissiondate WHERE id=:id", admissiondate=admissiondate, id=int(id))
-            db.execute("UPDATE students SET monthlyfee=:monthlyfee WHERE id=:id", monthlyfee=int(monthlyfee), id=int(id))
-            db.execute("UPDATE students SET status=:status WHERE id=:id", status=status, id=int(id))
-
-            student = db.execute("SELECT * FROM students WHERE id=:id", id=int(id))
+            db.update("students", int(id), values)
 
             return jsonify([{"status": "success", "msg": "Changes saved."}])
     else:
         return redirect(url_for("home"))
 
+### Columns of a student, as named in the add student form and in import CSV files
+STUDENT_FIELDS = ["firstname", "lastname", "fathername", "contact", "gender", "dob", "address", "class", "admissiondate", "monthlyfee"]
+
+### Validate the details of a new student. Returns an error message, or None if the details are valid
+def validatestudent(student):
+    for field in STUDENT_FIELDS:
+        if student.get(field) is None or student.get(field) == "":
+            return "Incomplete Details."
+    if RepresentsInt(student["monthlyfee"]) != True:
+        return "Incompatible Details."
+    if student.get("status", "Active") != "Active" and student.get("status", "Active") != "Inactive":
+        return "Invalid status."
+    return None
+
 ### Add new student via ajax
 @server.route("/addnewstudent", methods=["GET", "POST"])
 def addnewstudent():
     if g.user:
         if request.method == "POST":
-            firstname = request.values.get("firstname")
-            lastname = request.values.get("lastname")
-            fathername = request.values.get("fathername")
-            contact = request.values.get("contact")
-            gender = request.values.get("gender")
-            dob = request.values.get("dob")
-            address = request.values.get("address")
-            class_ = request.values.get("class")
-            admissiondate = request.values.get("admissiondate")
-            monthlyfee = request.values.get("monthlyfee")
+            student = {}
+            for field in STUDENT_FIELDS:
+                student[field] = request.values.get(field)
             image = request.files["imgURL"]
 
-            students = db.execute("SELECT * FROM students")
+            error = validatestudent(student)
+            if error is not None:
+                return jsonify([{"status": "error", "msg": error}])
 
-            if firstname == "" or lastname == "" or fathername == "" or contact == "" or gender == "" or dob == "" or address == "" or class_ == "" or admissiondate == "" or monthlyfee == "":
-                return jsonify([{"status": "error", "msg": "Incomplete Details."}])
-            elif RepresentsInt(monthlyfee) != True:
-                return jsonify([{"status": "error", "msg": "Incompatible Details."}])
+            if image and allowed_file(image.filename) != True:
+                return jsonify([{"status": "error", "msg": "File extension not supported."}])
 
-            imgURL = "../static/img/system/default-prof-img.png"
+            variants = None
             if image:
-                if allowed_file(image.filename) == True:
-                    db.execute("INSERT INTO students (firstname, lastname, fathername, contact, gender, dob, address, class, admissiondate, monthlyfee, imgURL) VALUES (:firstname, :lastname, :fathername, :contact, :gender, :dob, :address, :class_, :admissiondate, :monthlyfee, :imgURL)", firstname=firstname, lastname=lastname, fathername=fathername, contact=contact, gender=gender, dob=dob, address=address, class_=class_, admissiondate=admissiondate, monthlyfee=int(monthlyfee), imgURL=imgURL)
-
-                    students_ = db.execute("SELECT * FROM students")
-                    student = None
-                    for i in range(len(students_)):
-                        for j in range(len(students_)):
-                            if students_[i]["id"] >= students_[j]["id"]:
-                                student = students_[i]
-
-                    if student != None and student['firstname'] == firstname and student['lastname'] == lastname and student['fathername'] == fathername and student['gender'] == gender and student['dob'] == dob and student['address'] == address and student['class'] == class_ and student['admissiondate'] == admissiondate and student['monthlyfee'] == int(monthlyfee):
-                        id = student['id']
-                        imagename = image.filename
-                        imageext = imagename.split(".")[-1]
-                        imagename = "student_" + str(id) + "." + imageext
-                        image.save(os.path.join(THIS_FOLDER_G + "/static/img/db/students/", imagename))
-                        imgURL = "../static/img/db/students/" + imagename
-                        db.execute("UPDATE students SET imgURL=:imgURL WHERE id=:id", imgURL=imgURL, id=int(id))
-                else:
-                    return jsonify([{"status": "error", "msg": "File extension not supported."}])
-            else:
-                db.execute("INSERT INTO students (firstname, lastname, fathername, contact, gender, dob, address, class, admissiondate, monthlyfee, imgURL) VALUES (:firstname, :lastname, :fathername, :contact, :gender, :dob, :address, :class_, :admissiondate, :monthlyfee, :imgURL)", firstname=firstname, lastname=lastname, fathername=fathername, contact=contact, gender=gender, dob=dob, address=address, class_=class_, admissiondate=admissiondate, monthlyfee=int(monthlyfee), imgURL=imgURL)
+                try:
+                    variants = processimage(image.read())
+                except ValueError as error:
+                    return jsonify([{"status": "error", "msg": str(error)}])
+
+            imgURL = "../static/img/system/default-prof-img.png"
+            id = db.execute("INSERT INTO students (firstname, lastname, fathername, contact, gender, dob, address, class, admissiondate, monthlyfee, imgURL) VALUES (:firstname, :lastname, :fathername, :contact, :gender, :dob, :address, :class_, :admissiondate, :monthlyfee, :imgURL)", firstname=student["firstname"], lastname=student["lastname"], fathername=student["fathername"], contact=student["contact"], gender=student["gender"], dob=student["dob"], address=student["address"], class_=student["class"], admissiondate=student["admissiondate"], monthlyfee=int(student["monthlyfee"]), imgURL=imgURL)
+
+            if variants is not None:
+                imgURL = saveimage(variants)
+                db.execute("UPDATE students SET imgURL=:imgURL WHERE id=:id", imgURL=imgURL, id=int(id))
 
             return jsonify([{"status": "success", "msg": "Changes saved."}])
     else:
         return redirect(url_for("home"))
 
+### Import students from CSV rows (dicts keyed by STUDENT_FIELDS, optionally "status" and "photo").
+### Photos are looked up in an optional zip file, by the row's "photo" column or else as <row number>.<ext>.
+### All rows are inserted in one transaction. Unless skipinvalid is set, any invalid row cancels the import.
+### Returns the number of imported students and a list of {"row", "msg"} errors. Raises ValueError if the
+### database refuses the rows, then nothing is imported.
+def importstudents(rows, photos=None, skipinvalid=False):
+    photonames = {}
+    if photos is not None:
+        for name in photos.namelist():
+            photonames[os.path.basename(name)] = name
+
+    students = []
+    # the processimage variants of each student's photo, or None
+    images = []
+    errors = []
+    for i, row in enumerate(rows, start=1):
+        student = {}
+        for field in STUDENT_FIELDS + ["status", "photo"]:
+            student[field] = (row.get(field) or "").strip()
+        if student["status"] == "":
+            student["status"] = "Active"
+
+        error = validatestudent(student)
+        photo = None
+        if error is None and photos is not None:
+            if student["photo"] != "":
+                photo = photonames.get(os.path.basename(student["photo"]))
+                if photo is None:
+                    error = "Photo " + student["photo"] + " not found."
+            else:
+                for ext in server.config["ALLOWED_EXTENSIONS"]:
+                    if str(i) + "." + ext in photonames:
+                        photo = photonames[str(i) + "." + ext]
+                        break
+            if photo is not None and allowed_file(photo) != True:
+                error = "File extension not supported."
+            elif photo is not None:
+                # resized before the transaction, which holds the write lock, begins
+                try:
+                    variants = processimage(photos.read(photo))
+                except ValueError:
+                    error = "Invalid image " + photo + "."
+        if error is not None:
+            errors.append({"row": i, "msg": error})
+            continue
+
+        student["monthlyfee"] = int(student["monthlyfee"])
+        student["imgURL"] = "../static/img/system/default-prof-img.png"
+        del student["photo"]
+        students.append(student)
+        images.append(variants if photo is not None else None)
+
+    if len(students) < 1 or (len(errors) > 0 and skipinvalid != True):
+        return 0, errors
+
+    with db.transaction() as transaction:
+        lastid = transaction.execute("SELECT IFNULL(MAX(id), 0) AS id FROM students")[0]["id"]
+        if transaction.executemany("INSERT INTO students (firstname, lastname, fathername, contact, gender, dob, address, class, admissiondate, monthlyfee, imgURL, status) VALUES (:firstname, :lastname, :fathername, :contact, :gender, :dob, :address, :class, :admissiondate, :monthlyfee, :imgURL, :status)", students) is None:
+            # a constraint failed part way, leaving the transaction rolls back the rows before it
+            raise ValueError("The students could not be saved, nothing was imported.")
+        # the write lock is held since the transaction began, so the new rows got the IDs after lastid in insertion order
+        ids = transaction.execute("SELECT id FROM students WHERE id>:id ORDER BY id", id=lastid)
+
+        imgURLs = [{"id": row["id"], "imgURL": saveimage(variants, transaction)} for variants, row in zip(images, ids) if variants is not None]
+        transaction.executemany("UPDATE students SET imgURL=:imgURL WHERE id=:id", imgURLs)
+
+    return len(students), errors
+
+### Read CSV data (bytes) into dicts keyed by the lowercased header names
+def readcsv(data):
+    reader = csv.DictReader(io.StringIO(data.decode("utf-8-sig"), newline=""))
+    if reader.fieldnames is not None:
+        reader.fieldnames = [name.strip().lower() for name in reader.fieldnames]
+    return list(reader)
+
+### Import students from an uploaded CSV file, and optionally a zip file of their photos, via ajax
+@server.route("/importstudents", methods=["POST"])
+def importstudentsfile():
+    if g.user:
+        csvfile = request.files.get("csv")
+        photosfile = request.files.get("photos")
+        skipinvalid = request.values.get("skipinvalid") == "true"
+
+        if not csvfile:
+            return jsonify([{"status": "error", "msg": "Select a CSV file."}])
+
+        try:
+            rows = readcsv(csvfile.read())
+        except (UnicodeDecodeError, csv.Error):
+            return jsonify([{"status": "error", "msg": "Could not read the CSV file."}])
+
+        photos = None
+        if photosfile:
+            try:
+                photos = zipfile.ZipFile(io.BytesIO(photosfile.read()))
+            except zipfile.BadZipfile:
+                return jsonify([{"status": "error", "msg": "Could not read the photos zip file."}])
+
+        try:
+            imported, errors = importstudents(rows, photos, skipinvalid)
+        except ValueError as error:
+            return jsonify([{"status": "error", "msg": str(error)}])
+        if imported < 1 and len(errors) > 0:
+            return jsonify([{"status": "error", "msg": "Nothing imported, " + str(len(errors)) + " invalid rows.", "imported": 0, "errors": errors}])
+        return jsonify([{"status": "success", "msg": str(imported) + " students imported.", "imported": imported, "errors": errors}])
+    else:
+        return redirect(url_for("home"))
+
+### Import students from the command line: FLASK_APP=server.py flask import-students students.csv
+@server.cli.command("import-students")
+@click.argument("csvpath", type=click.Path(exists=True, dir_okay=False))
+@click.option("--photos", type=click.Path(exists=True, dir_okay=False), help="Zip file of student photos.")
+@click.option("--skip-invalid", is_flag=True, help="Import the valid rows even if some rows are invalid.")
+def importstudentscommand(csvpath, photos, skip_invalid):
+    migrate(db)
+    with open(csvpath, "rb") as f:
+        rows = readcsv(f.read())
+    try:
+        imported, errors = importstudents(rows, zipfile.ZipFile(photos) if photos else None, skip_invalid)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    for error in errors:
+        click.echo("Row " + str(error["row"]) + ": " + error["msg"], err=True)
+    click.echo(str(imported) + " students imported.")
+
 ### Delete student based on student ID
 @server.route("/deletestudent/<id>", methods=["GET", "POST"])
 def deletestudent(id):
     id = id
-    students = db.execute("SELECT * FROM students WHERE id=:id", id=int(id))
-    imgExt = students[0]["imgURL"]
-    imgExt = imgExt.split(".")
-    imgExt = imgExt[-1]
-    try:
-        os.remove(os.path.join(THIS_FOLDER_G + "/static/img/db/students/", "student_" + id + "." + imgExt))
-    except:
-        pass
     db.execute("DELETE FROM students WHERE id=:id", id=int(id))
     db.execute("DELETE FROM testrecords WHERE studentID=:studentID", studentID=int(id))
     db.execute("DELETE FROM feerecords WHERE studentID=:studentID", studentID=int(id))
     return redirect(url_for("students"))
 
 
+'''
+    Bulk operations
+'''
+### Student column changed by each bulk operation
+BULK_FIELDS = {"promote": "class", "status": "status", "monthlyfee": "monthlyfee"}
+
+### Students listed in the preview of a bulk operation
+BULK_PREVIEW_SIZE = 20
+
+### Student IDs a bulk operation can be limited to, each is a bound parameter and SQLite before 3.32
+### allows 999 in a statement
+BULK_MAX_IDS = 900
+
+### The students a bulk operation in the request changes and their new value: a dict of operation, field,
+### value (SQL expression), where (SQL condition), params and description. Raises ValueError if invalid.
+### Only students whose value actually changes are matched.
+def bulkoperation():
+    operation = request.values.get("operation", "")
+    class_ = request.values.get("class", "").strip()
+    status = request.values.get("status", "").strip()
+    ids = request.values.get("studentIDs", "").replace(" ", "").strip(",")
+
+    conditions = []
+    params = {}
+    if operation == "promote":
+        toclass = request.values.get("toclass", "").strip()
+        if class_ == "" or toclass == "":
+            raise ValueError("Incomplete data.")
+        if class_ == toclass:
+            raise ValueError("Select a different class to promote to.")
+        # inactive students (e.g. graduated) stay in their class
+        status = "Active"
+        value = ":toclass"
+        params["toclass"] = toclass
+        description = "Promote class " + class_ + " to " + toclass
+    elif operation == "status":
+        newstatus = request.values.get("newstatus", "")
+        if newstatus != "Active" and newstatus != "Inactive":
+            raise ValueError("Invalid status.")
+        value = ":newstatus"
+        params["newstatus"] = newstatus
+        description = ("Deactivate" if newstatus == "Inactive" else "Reactivate") + " students"
+    elif operation == "monthlyfee":
+        mode = request.values.get("mode", "set")
+        amount = request.values.get("amount", "").strip()
+        if (mode != "set" and mode != "add") or RepresentsInt(amount) != True or (mode == "set" and int(amount) < 0):
+            raise ValueError("Incompatible data.")
+        value = ":amount" if mode == "set" else "MAX(IFNULL(monthlyfee, 0) + :amount, 0)"
+        params["amount"] = int(amount)
+        description = ("Set monthly fee to " if mode == "set" else "Change monthly fee by ") + amount
+    else:
+        raise ValueError("Unknown operation.")
+
+    if class_ != "":
+        conditions.append("class=:class")
+        params["class"] = class_
+        if operation != "promote":
+            description += " of class " + class_
+    if status != "":
+        if status != "Active" and status != "Inactive":
+            raise ValueError("Invalid status.")
+        conditions.append("status=:status")
+        params["status"] = status
+    if ids != "":
+        ids = ids.split(",")
+        if any(RepresentsInt(id) != True for id in ids):
+            raise ValueError("Incompatible data.")
+        if len(ids) > BULK_MAX_IDS:
+            raise ValueError("Select at most " + str(BULK_MAX_IDS) + " student IDs, or filter by class instead.")
+        conditions.append("id IN (" + ", ".join(":id" + str(i) for i in range(len(ids))) + ")")
+        params.update(("id" + str(i), int(id)) for i, id in enumerate(ids))
+        description += " (" + str(len(ids)) + " selected)"
+
+    field = BULK_FIELDS[operation]
+    conditions.append(field + " IS NOT " + value)
+    return {"operation": operation, "field": field, "value": value, "where": " AND ".join(conditions), "params": params, "description": description}
+
+### Bulk operations page
+@server.route("/bulkoperations")
+def bulkoperations():
+    if g.user and g.role == "root":
+        classes = db.execute("SELECT DISTINCT class FROM students WHERE class IS NOT NULL")
+        return render_template("bulkoperations.html", classes=sorted([row["class"] for row in classes], key=classkey))
+    else:
+        return redirect(url_for("home"))
+
+### Get the latest bulk operations via ajax
+@server.route("/getbulkoperations", methods=["GET", "POST"])
+def getbulkoperations():
+    if g.user and g.role == "root":
+        return jsonify(db.execute("SELECT bulkoperations.*, admins.firstname || ' ' || admins.lastname AS admin FROM bulkoperations LEFT JOIN admins ON admins.id=bulkoperations.adminID ORDER BY bulkoperations.id DESC LIMIT 50"))
+    else:
+        return redirect(url_for("home"))
+
+### Preview or apply a bulk operation via ajax. Values: operation (promote/status/monthlyfee), the filters
+### class, status and studentIDs (comma separated), toclass (promote), newstatus (status), mode (set/add)
+### and amount (monthlyfee), dryrun. A dry run counts the students that would change by their current
+### value and lists some of them. Otherwise the students are changed in one UPDATE, in the same
+### transaction that records their old values for undo.
+@server.route("/applybulkoperation", methods=["GET", "POST"])
+def applybulkoperation():
+    if g.user and g.role == "root":
+        if request.method == "POST":
+            try:
+                operation = bulkoperation()
+            except ValueError as error:
+                return jsonify([{"status": "error", "msg": str(error)}])
+            field = operation["field"]
+            where = operation["where"]
+            params = operation["params"]
+
+            if request.values.get("dryrun", "") == "true":
+                changes = db.execute("SELECT " + field + " AS value, COUNT(*) AS students FROM students WHERE " + where + " GROUP BY " + field + " ORDER BY " + field, **params)
+                sample = db.execute("SELECT id, firstname, lastname, fathername, class, status, monthlyfee, " + operation["value"] + " AS newvalue FROM students WHERE " + where + " ORDER BY firstname COLLATE NOCASE, lastname COLLATE NOCASE LIMIT :limit", limit=BULK_PREVIEW_SIZE, **params)
+                students = sum(change["students"] for change in changes)
+                return jsonify([{"status": "success", "msg": operation["description"] + ": " + str(students) + " students will change.", "students": students, "changes": changes, "sample": sample}])
+
+            with db.transaction() as transaction:
+                if transaction.execute("SELECT EXISTS (SELECT 1 FROM students WHERE " + where + ") AS found", **params)[0]["found"] == 0:
+                    return jsonify([{"status": "error", "msg": operation["description"] + ": no students to change."}])
+                id = transaction.execute("INSERT INTO bulkoperations (operation, field, description, adminID, created) VALUES (:operation, :field, :description, :adminID, :created)",
+                                         operation=operation["operation"], field=field, description=operation["description"], adminID=int(g.user), created=time.strftime("%Y-%m-%d %H:%M:%S"))
+                transaction.execute("INSERT INTO bulksnapshots (operationID, studentID, oldvalue, newvalue) SELECT :operationID, id, " + field + ", " + operation["value"] + " FROM students WHERE " + where, operationID=id, **params)
+                # bumping version here spares the version trigger an UPDATE per student
+                students = transaction.execute("UPDATE students SET " + field + "=" + operation["value"] + ", version=version + 1 WHERE " + where, **params)
+                transaction.execute("UPDATE bulkoperations SET students=:students WHERE id=:id", students=students, id=id)
+
+            return jsonify([{"status": "success", "msg": operation["description"] + ": " + str(students) + " students changed.", "id": id, "students": students}])
+    else:
+        return redirect(url_for("home"))
+
+### Undo a bulk operation via ajax. Values: id. Students changed again since keep their newer value.
+@server.route("/undobulkoperation", methods=["GET", "POST"])
+def undobulkoperation():
+    if g.user and g.role == "root":
+        if request.method == "POST":
+            id = request.values.get("id", "")
+            if RepresentsInt(id) != True:
+                return jsonify([{"status": "error", "msg": "Incompatible data."}])
+
+            with db.transaction() as transaction:
+                operation = transaction.execute("SELECT * FROM bulkoperations WHERE id=:id", id=int(id))
+                if len(operation) < 1 or operation[0]["field"] not in BULK_FIELDS.values():
+                    return jsonify([{"status": "error", "msg": "Operation not found."}])
+                if operation[0]["undone"] is not None:
+                    return jsonify([{"status": "error", "msg": "Operation already undone."}])
+                field = operation[0]["field"]
+                restored = transaction.execute("UPDATE students SET " + field + "=(SELECT oldvalue FROM bulksnapshots WHERE operationID=:id AND studentID=students.id), version=version + 1 WHERE id IN (SELECT studentID FROM bulksnapshots WHERE operationID=:id) AND " + field + " IS (SELECT newvalue FROM bulksnapshots WHERE operationID=:id AND studentID=students.id)", id=int(id))
+                transaction.execute("UPDATE bulkoperations SET undone=:undone, restored=:restored WHERE id=:id", undone=time.strftime("%Y-%m-%d %H:%M:%S"), restored=restored, id=int(id))
+
+            skipped = operation[0]["students"] - restored
+            return jsonify([{"status": "success", "msg": str(restored) + " students restored." + (" " + str(skipped) + " changed since were left as they are." if skipped > 0 else ""), "restored": restored}])
+    else:
+        return redirect(url_for("home"))
+
+
 '''
     Test Records
 '''
+### Filters accepted by the test/fee record listings. Request value name -> SQL condition
+RECORD_FILTERS = {
+    "testrecords": {
+        "studentID": "studentID=:studentID",
+        "class": "class=:class",
+        "subject": "subject=:subject",
+        "datefrom": "date>=:datefrom",
+        "dateto": "date<=:dateto"
+    },
+    "feerecords": {
+        "studentID": "studentID=:studentID",
+        "class": "studentID IN (SELECT id FROM students WHERE class=:class)",
+        "feefor": "feefor=:feefor",
+        "period": "period=:period",
+        "datefrom": "date>=:datefrom",
+        "dateto": "date<=:dateto"
+    }
+}
+
+### Columns matched by the search box of the test/fee record listings
+RECORD_SEARCH_COLUMNS = {
+    "testrecords": ["studentName", "subject", "description"],
+    "feerecords": ["studentName", "feefor"]
+}
+
+### WHERE conditions and parameters for the RECORD_FILTERS given in the request
+def recordfilters(table):
+    conditions = []
+    params = {}
+    for name, condition in RECORD_FILTERS[table].items():
+        value = request.values.get(name, "").strip()
+        if value != "":
+            conditions.append(condition)
+            params[name] = int(value) if name == "studentID" else value
+    return conditions, params
+
+### Fetch a page of test/fee records newest first, paged with the "before" cursor (a record ID).
+### With "draw" the response follows DataTables' server-side processing protocol. Its pages are still read
+### by cursor: the table (see static/js/recordcursors.js) sends the ID a page it has seen a page or two earlier
+### ends at, and "skip" for the rows in between. Other pages, e.g. the last one, are read from whichever end
+### of the table is nearer. Without "draw" no counting is done.
+def recordspage(table):
+    draw = request.values.get("draw")
+    start = request.values.get("start", "0")
+    length = request.values.get("length", request.values.get("limit", "50"))
+    before = request.values.get("before", "")
+    skip = request.values.get("skip", "0")
+    search = request.values.get("search[value]", "").strip()
+
+    if RepresentsInt(start) != True or RepresentsInt(length) != True or RepresentsInt(skip) != True or (before != "" and RepresentsInt(before) != True) or (draw is not None and RepresentsInt(draw) != True):
+        return jsonify([{"status": "error", "msg": "Incompatible data."}])
+    if request.values.get("studentID", "") != "" and RepresentsInt(request.values.get("studentID")) != True:
+        return jsonify([{"status": "error", "msg": "Incompatible data."}])
+
+    length = int(length)
+    if length < 1 or length > 500:
+        length = 500
+
+    conditions, params = recordfilters(table)
+
+    if search != "":
+        searches = [column + " LIKE :search ESCAPE '!'" for column in RECORD_SEARCH_COLUMNS[table]]
+        params["search"] = like_pattern(search)
+        if RepresentsInt(search) == True:
+            searches.append("id=:searchid")
+            searches.append("studentID=:searchid")
+            params["searchid"] = int(search)
+        conditions.append("(" + " OR ".join(searches) + ")")
+
+    where = " WHERE " + " AND ".join(conditions) if len(conditions) > 0 else ""
+
+    if draw is None:
+        if before != "":
+            where += (" AND " if where != "" else " WHERE ") + "id<:before"
+            params["before"] = int(before)
+        records = db.execute("SELECT * FROM " + table + where + " ORDER BY id DESC LIMIT :limit", limit=length, **params)
+        cursor = records[-1]["id"] if len(records) == length else None
+        return jsonify({"records": records, "next": cursor})
+
+    # kept by the counters triggers (migration 4)
+    total = db.execute("SELECT value FROM counters WHERE name=:name", name=table)[0]["value"]
+    if where != "":
+        filtered = db.execute("SELECT COUNT(*) AS total FROM " + table + where, **params)[0]["total"]
+    else:
+        filtered = total
+
+    start = max(int(start), 0)
+    skip = max(int(skip), 0)
+    # a cursor further from the page than the oldest record is not worth skipping from
+    if before != "" and skip <= filtered - start:
+        where += (" AND " if where != "" else " WHERE ") + "id<:before"
+        params["before"] = int(before)
+        records = db.execute("SELECT * FROM " + table + where + " ORDER BY id DESC LIMIT :limit OFFSET :offset", limit=length, offset=skip, **params)
+    elif start * 2 > filtered:
+        # a page in the older half, e.g. the last page, counted from the oldest record
+        limit = max(min(length, filtered - start), 0)
+        records = db.execute("SELECT * FROM (SELECT * FROM " + table + where + " ORDER BY id ASC LIMIT :limit OFFSET :offset) ORDER BY id DESC", limit=limit, offset=max(filtered - start - limit, 0), **params)
+    else:
+        records = db.execute("SELECT * FROM " + table + where + " ORDER BY id DESC LIMIT :limit OFFSET :offset", limit=length, offset=start, **params)
+    return jsonify({"draw": int(draw), "recordsTotal": total, "recordsFiltered": filtered, "data": records})
+
 ### Main test records page
 @server.route("/testrecords")
 def testrecords():
     if g.user:
-        records = db.execute("SELECT * FROM testrecords")
-        return render_template("testrecords.html", records=records)
+        return render_template("testrecords.html")
     else:
         return redirect(url_for("home"))
 
@@ -653,9 +1969,15 @@ def testrecords():
 @server.route("/alltestrecords")
 def alltestrecords():
     if g.user:
-        records = db.execute("SELECT * FROM testrecords")
-        records.reverse()
-        return render_template("alltestrecords.html", records=records)
+        return render_template("alltestrecords.html")
+    else:
+        return redirect(url_for("home"))
+
+### Get a page of test records via ajax, newest first
+@server.route("/gettestrecords", methods=["GET", "POST"])
+def gettestrecords():
+    if g.user:
+        return recordspage("testrecords")
     else:
         return redirect(url_for("home"))
 
@@ -663,11 +1985,10 @@ def alltestrecords():
 @server.route("/testrecord/<id>")
 def fetchtestrecord(id):
     if g.user:
-        records = db.execute("SELECT * FROM testrecords WHERE studentID=:id", id=int(id))
+        records = db.execute("SELECT * FROM testrecords WHERE studentID=:id ORDER BY id DESC", id=int(id))
         if len(records) < 1:
             return render_template("notfound.html", msg="Record Not Found.")
         else:
-            records.reverse()
             return render_template("studenttestrecord.html", records=records)
     else:
         return redirect(url_for("home"))
@@ -688,34 +2009,104 @@ def addstudenttestrecord(id):
     else:
         return redirect(url_for("home"))
 
+### Validate a new test record. Returns an error message, or None if the record is valid
+def validatetestrecord(record):
+    if record.get("studentID", "") == "" or record.get("date", "") == "" or record.get("subject", "") == "" or record.get("totalmarks", "") == "" or record.get("obtainedmarks", "") == "":
+        return "Incomplete data."
+    elif RepresentsInt(record["studentID"]) != True or RepresentsInt(record["totalmarks"]) != True or RepresentsInt(record["obtainedmarks"]) != True:
+        return "Incompatible data."
+    elif int(record["totalmarks"]) == 0:
+        return "Incompatible data."
+    return None
+
+### Values of the testrecords row for a valid test record of a student
+def testrecordrow(record, student):
+    return {
+        "studentID": int(student["id"]),
+        "studentName": str(student["firstname"] + " " + student["lastname"]),
+        "studentFrName": student["fathername"],
+        "date": record["date"],
+        "class": student["class"],
+        "subject": record["subject"],
+        "description": record.get("description"),
+        "totalmarks": int(record["totalmarks"]),
+        "obtainedmarks": int(record["obtainedmarks"]),
+        "obtainedpercentage": int(int(record["obtainedmarks"])/int(record["totalmarks"])*100),
+        "remarks": record.get("remarks")
+    }
+
+TESTRECORD_INSERT = "INSERT INTO testrecords (studentID, studentName, studentFrName, date, class, subject, description, totalmarks, obtainedmarks, obtainedpercentage, remarks) VALUES (:studentID, :studentName, :studentFrName, :date, :class, :subject, :description, :totalmarks, :obtainedmarks, :obtainedpercentage, :remarks)"
+
 ### Add new test records via ajax
 @server.route("/addnewtestrecord", methods=["POST"])
 def addnewtestrecord():
     if g.user:
         if request.method == "POST":
-            studentID = request.values.get("studentID")
-            date = request.values.get("date")
-            subject = request.values.get("subject")
-            description = request.values.get("description")
-            totalmarks = request.values.get("totalmarks")
-            obtainedmarks = request.values.get("obtainedmarks")
-            remarks = request.values.get("remarks")
+            record = {}
+            for field in ["studentID", "date", "subject", "description", "totalmarks", "obtainedmarks", "remarks"]:
+                record[field] = request.values.get(field)
 
-            if studentID == "" or date == "" or subject == "" or totalmarks == "" or obtainedmarks == "":
-                return jsonify([{"status": "error", "msg": "Incomplete data."}])
-            elif RepresentsInt(studentID) != True or RepresentsInt(totalmarks) != True or RepresentsInt(obtainedmarks) != True:
-                return jsonify([{"status": "error", "msg": "Incompatible data."}])
+            error = validatetestrecord(record)
+            if error is not None:
+                return jsonify([{"status": "error", "msg": error}])
 
-            student = db.execute("SELECT * FROM students WHERE id=:id", id=int(studentID))
+            student = db.execute("SELECT * FROM students WHERE id=:id", id=int(record["studentID"]))
             if len(student) < 1:
                 return jsonify([{"status": "error", "msg": "No Student with entered ID."}])
 
-
-            db.execute("INSERT INTO testrecords (studentID, studentName, studentFrName, date, class, subject, description, totalmarks, obtainedmarks, obtainedpercentage, remarks) VALUES (:studentID, :studentName, :studentFrName, :date, :class_, :subject, :description, :totalmarks, :obtainedmarks, :obtainedpercentage, :remarks)", studentID=int(student[0]["id"]), studentName=str(student[0]["firstname"] + " " + student[0]["lastname"]), studentFrName=student[0]["fathername"], date=date, class_=student[0]["class"], subject=subject, description=description, totalmarks=int(totalmarks), obtainedmarks=int(obtainedmarks), obtainedpercentage=int(int(obtainedmarks)/int(totalmarks)*100), remarks=remarks)
+            db.execute(TESTRECORD_INSERT, **testrecordrow(record, student[0]))
             return jsonify([{"status": "success", "msg": "Changes saved."}])
     else:
         return redirect(url_for("home"))
 
+### Add many test records at once via ajax. Expects a JSON array of records [{studentID, date, subject, ...}, ...],
+### or {"records": [...]}. Valid records are inserted together in one transaction; the response has a result for every record.
+@server.route("/addnewtestrecords", methods=["POST"])
+def addnewtestrecords():
+    if g.user:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            data = data.get("records")
+        if not isinstance(data, list) or len(data) > 1000:
+            return jsonify([{"status": "error", "msg": "Incompatible data."}])
+
+        records = []
+        results = []
+        for record in data:
+            if not isinstance(record, dict):
+                record = {}
+            # accept numbers as well as strings from JSON
+            record = dict((field, "" if value is None else str(value)) for field, value in record.items())
+            records.append(record)
+            error = validatetestrecord(record)
+            results.append({"status": "error", "msg": error} if error is not None else None)
+
+        ids = sorted(set(int(record["studentID"]) for record, result in zip(records, results) if result is None))
+        students = {}
+        # in chunks, SQLite before 3.32 allows 999 bound parameters in a statement
+        for chunk in range(0, len(ids), 900):
+            params = dict(("id" + str(i), id) for i, id in enumerate(ids[chunk:chunk + 900]))
+            for student in db.execute("SELECT * FROM students WHERE id IN (" + ", ".join(":" + name for name in sorted(params)) + ")", **params):
+                students[student["id"]] = student
+
+        rows = []
+        for i, record in enumerate(records):
+            if results[i] is not None:
+                continue
+            student = students.get(int(record["studentID"]))
+            if student is None:
+                results[i] = {"status": "error", "msg": "No Student with entered ID."}
+                continue
+            rows.append(testrecordrow(record, student))
+            results[i] = {"status": "success", "msg": "Changes saved."}
+
+        with db.transaction() as transaction:
+            transaction.executemany(TESTRECORD_INSERT, rows)
+
+        return jsonify(results)
+    else:
+        return redirect(url_for("home"))
+
 ### Edit test record
 @server.route("/edittestrecord/<id>")
 def edittestrecord(id):
@@ -755,17 +2146,7 @@ def updatetestrecord(id):
             if len(student) < 1:
                 return jsonify([{"status": "error", "msg": "No Student with entered ID."}])
 
-            db.execute("UPDATE testrecords SET studentID=:studentID WHERE id=:id", studentID=studentID, id=int(id))
-            db.execute("UPDATE testrecords SET studentName=:studentName WHERE id=:id", studentName=studentName, id=int(id))
-            db.execute("UPDATE testrecords SET studentFrName=:studentFrName WHERE id=:id", studentFrName=studentFrName, id=int(id))
-            db.execute("UPDATE testrecords SET date=:date WHERE id=:id", date=date, id=int(id))
-            db.execute("UPDATE testrecords SET class=:class_ WHERE id=:id", class_=class_, id=int(id))
-            db.execute("UPDATE testrecords SET subject=:subject WHERE id=:id", subject=subject, id=int(id))
-            db.execute("UPDATE testrecords SET description=:description WHERE id=:id", description=description, id=int(id))
-            db.execute("UPDATE testrecords SET totalmarks=:totalmarks WHERE id=:id", totalmarks=totalmarks, id=int(id))
-            db.execute("UPDATE testrecords SET obtainedmarks=:obtainedmarks WHERE id=:id", obtainedmarks=obtainedmarks, id=int(id))
-            db.execute("UPDATE testrecords SET obtainedpercentage=:obtainedpercentage WHERE id=:id", obtainedpercentage=int(int(obtainedmarks)/int(totalmarks)*100), id=int(id))
-            db.execute("UPDATE testrecords SET remarks=:remarks WHERE id=:id", remarks=remarks, id=int(id))
+            db.update("testrecords", int(id), {"studentID": int(studentID), "studentName": studentName, "studentFrName": studentFrName, "date": date, "class": class_, "subject": subject, "description": description, "totalmarks": int(totalmarks), "obtainedmarks": int(obtainedmarks), "obtainedpercentage": int(int(obtainedmarks)/int(totalmarks)*100), "remarks": remarks})
 
             return jsonify([{"status": "success", "msg": "Changes saved."}])
     else:
@@ -779,6 +2160,239 @@ def deletetestrecord(id):
     return redirect(url_for("testrecords"))
 
 
+'''
+    Student analytics
+'''
+### Analytics of the students viewed recently, with the version of their test records they were computed
+### from (see migration 11). A change to a student's test records, from any route or process, bumps the
+### version and the next request computes them again.
+STUDENT_ANALYTICS_CACHE_SIZE = setting("analytics", "cache_size", 1000)
+studentanalytics_cache = collections.OrderedDict()
+studentanalytics_lock = threading.Lock()
+
+### Percentage of one test, NULL for tests without marks
+TEST_PERCENTAGE = "obtainedmarks * 100.0 / NULLIF(totalmarks, 0)"
+
+def testsversion(id):
+    versions = db.execute("SELECT version FROM testversions WHERE studentID=:id", id=id)
+    return versions[0]["version"] if len(versions) > 0 else 0
+
+def computestudentanalytics(id):
+    overall = db.execute("SELECT COUNT(*) AS tests, SUM(obtainedmarks) AS obtainedmarks, SUM(totalmarks) AS totalmarks, ROUND(SUM(obtainedmarks) * 100.0 / NULLIF(SUM(totalmarks), 0), 2) AS percentage, MIN(date) AS firstdate, MAX(date) AS lastdate FROM testrecords WHERE studentID=:id", id=id)[0]
+
+    # least squares slope of the percentages in test order, in percentage points per test
+    overall["trend"] = db.execute("""SELECT ROUND((COUNT(*) * SUM(n * percentage) - SUM(n) * SUM(percentage)) / NULLIF(COUNT(*) * SUM(n * n) - SUM(n) * SUM(n), 0), 2) AS trend
+        FROM (SELECT ROW_NUMBER() OVER (ORDER BY date, id) AS n, """ + TEST_PERCENTAGE + """ AS percentage FROM testrecords WHERE studentID=:id) WHERE percentage IS NOT NULL""", id=id)[0]["trend"]
+
+    subjects = db.execute("SELECT subject, COUNT(*) AS tests, SUM(obtainedmarks) AS obtainedmarks, SUM(totalmarks) AS totalmarks, ROUND(SUM(obtainedmarks) * 100.0 / NULLIF(SUM(totalmarks), 0), 2) AS percentage, ROUND(AVG(" + TEST_PERCENTAGE + "), 2) AS average, ROUND(MAX(" + TEST_PERCENTAGE + "), 2) AS best, ROUND(MIN(" + TEST_PERCENTAGE + "), 2) AS worst, MAX(date) AS lastdate FROM testrecords WHERE studentID=:id GROUP BY subject ORDER BY subject COLLATE NOCASE", id=id)
+
+    # every test in date order, with the percentage of all tests so far, the average of the last three
+    # and the change since the previous test of the same subject. Tests without a percentage (no total
+    # marks) rank after all others.
+    tests = db.execute("""SELECT id, date, class, subject, description, totalmarks, obtainedmarks, ROUND(percentage, 2) AS percentage,
+            ROUND(SUM(obtainedmarks) OVER running * 100.0 / NULLIF(SUM(totalmarks) OVER running, 0), 2) AS cumulative,
+            ROUND(AVG(percentage) OVER (ORDER BY date, id ROWS BETWEEN 2 PRECEDING AND CURRENT ROW), 2) AS movingaverage,
+            ROUND(percentage - LAG(percentage) OVER (PARTITION BY subject ORDER BY date, id), 2) AS change,
+            RANK() OVER (ORDER BY percentage IS NULL, percentage DESC) AS bestrank,
+            RANK() OVER (ORDER BY percentage IS NULL, percentage ASC) AS worstrank
+        FROM (SELECT *, """ + TEST_PERCENTAGE + """ AS percentage FROM testrecords WHERE studentID=:id)
+        WINDOW running AS (ORDER BY date, id)
+        ORDER BY date, id""", id=id)
+
+    rated = [test for test in tests if test["percentage"] is not None]
+    return {
+        "overall": overall,
+        "subjects": subjects,
+        "tests": tests,
+        "best": sorted([test for test in rated if test["bestrank"] <= 3], key=lambda test: test["bestrank"]),
+        "worst": sorted([test for test in rated if test["worstrank"] <= 3], key=lambda test: test["worstrank"])
+    }
+
+### Returns (version, analytics) of a student, from the cache while their test records are unchanged
+def studentanalytics(id):
+    version = testsversion(id)
+    with studentanalytics_lock:
+        cached = studentanalytics_cache.get(id)
+        if cached is not None and cached[0] == version:
+            studentanalytics_cache.move_to_end(id)
+            return cached
+
+    analytics = computestudentanalytics(id)
+    with studentanalytics_lock:
+        studentanalytics_cache[id] = (version, analytics)
+        studentanalytics_cache.move_to_end(id)
+        while len(studentanalytics_cache) > STUDENT_ANALYTICS_CACHE_SIZE:
+            studentanalytics_cache.popitem(last=False)
+    return version, analytics
+
+### Analytics page of a student's test records
+@server.route("/studentanalytics/<id>")
+def studentanalyticspage(id):
+    if g.user:
+        if RepresentsInt(id) != True:
+            return render_template("notfound.html", msg="Student Not Found.")
+        student = db.execute("SELECT id, firstname, lastname, fathername, class FROM students WHERE id=:id", id=int(id))
+        if len(student) < 1:
+            return render_template("notfound.html", msg="Student Not Found.")
+        return render_template("studentanalytics.html", student=student[0], analytics=studentanalytics(int(id))[1])
+    else:
+        return redirect(url_for("home"))
+
+### Get a student's analytics via ajax: overall (tests, marks, percentage, trend in percentage points per test),
+### subjects (marks, percentage, average/best/worst test), tests (with cumulative percentage, moving average,
+### change since the subject's previous test), best and worst (top three tests)
+@server.route("/getstudentanalytics/<id>", methods=["GET", "POST"])
+def getstudentanalytics(id):
+    if g.user:
+        if RepresentsInt(id) != True:
+            return jsonify([{"status": "error", "msg": "Incompatible data."}])
+        version, analytics = studentanalytics(int(id))
+        return conditionaljson("analytics-" + str(int(id)) + "-" + str(version), lambda: analytics)
+    else:
+        return redirect(url_for("home"))
+
+
+'''
+    Class reports
+'''
+### Filters of the class reports, a subset of the test record filters
+CLASSREPORT_FILTERS = ["class", "datefrom", "dateto"]
+
+### Width of the percentage bands of the score distributions, the last band includes 100
+CLASSREPORT_BAND = 10
+
+### Marks of every student in every subject they were tested in, and overall (subject ""), per class.
+### A single pass over testrecords, which idx_testrecords_report serves in group order.
+def classscores(conditions, params):
+    where = " WHERE " + " AND ".join(conditions) if len(conditions) > 0 else ""
+    return db.execute("""WITH scores AS (
+            SELECT class, studentID, subject, COUNT(*) AS tests, SUM(obtainedmarks) AS obtainedmarks, SUM(totalmarks) AS totalmarks
+            FROM testrecords""" + where + """ GROUP BY class, studentID, subject
+        ), totals AS (
+            SELECT * FROM scores
+            UNION ALL
+            SELECT class, studentID, '' AS subject, SUM(tests), SUM(obtainedmarks), SUM(totalmarks) FROM scores GROUP BY class, studentID
+        )
+        SELECT totals.*, students.firstname, students.lastname, students.fathername
+        FROM totals LEFT JOIN students ON students.id=totals.studentID""", **params)
+
+### Natural order of class names, "2" before "10"
+def classkey(class_):
+    return (0, int(class_), "") if RepresentsInt(class_) == True else (1, 0, class_)
+
+### Rank the scores within each class and subject, in one pass over them. Ties share the best rank, the
+### percentile is the share of the rest of the class with a lower percentage. Scores without marks are
+### listed last, unranked. Returns (rankings, summaries) in class and subject order, overall first.
+def rankscores(scores):
+    groups = {}
+    for score in scores:
+        score["percentage"] = round(score["obtainedmarks"] * 100.0 / score["totalmarks"], 2) if score["obtainedmarks"] is not None and score["totalmarks"] else None
+        score["rank"] = None
+        score["percentile"] = None
+        groups.setdefault((score["class"], score["subject"]), []).append(score)
+
+    rankings = []
+    summaries = []
+    for class_, subject in sorted(groups, key=lambda key: (classkey(key[0]), key[1].lower())):
+        group = groups[(class_, subject)]
+        group.sort(key=lambda score: (score["percentage"] is None, -(score["percentage"] or 0), score["studentID"]))
+        rated = [score["percentage"] for score in group if score["percentage"] is not None]
+        students = len(rated)
+
+        position = 0
+        for percentage, ties in itertools.groupby(group[:students], key=lambda score: score["percentage"]):
+            ties = list(ties)
+            below = students - position - len(ties)
+            for score in ties:
+                score["rank"] = position + 1
+                score["percentile"] = round(below * 100.0 / (students - 1), 1) if students > 1 else 100.0
+            position += len(ties)
+        rankings += group
+
+        distribution = [0] * (100 // CLASSREPORT_BAND)
+        for percentage in rated:
+            distribution[min(int(percentage // CLASSREPORT_BAND), len(distribution) - 1)] += 1
+        middle = students // 2
+        summaries.append({
+            "class": class_,
+            "subject": subject,
+            "students": len(group),
+            "average": round(sum(rated) / students, 2) if students > 0 else None,
+            "median": (rated[middle] if students % 2 == 1 else round((rated[middle - 1] + rated[middle]) / 2.0, 2)) if students > 0 else None,
+            "highest": rated[0] if students > 0 else None,
+            "lowest": rated[-1] if students > 0 else None,
+            "distribution": distribution
+        })
+    return rankings, summaries
+
+### The class report for the filters given in the request, None if they are invalid
+def classreport():
+    conditions = []
+    params = {}
+    for name in CLASSREPORT_FILTERS:
+        value = request.values.get(name, "").strip()
+        if value != "":
+            if name != "class" and re.match(r"^\d{4}-\d{2}-\d{2}$", value) is None:
+                return None
+            conditions.append(RECORD_FILTERS["testrecords"][name])
+            params[name] = value
+    return rankscores(classscores(conditions, params))
+
+### Class reports page
+@server.route("/classreports")
+def classreports():
+    if g.user:
+        classes = db.execute("SELECT DISTINCT class FROM testrecords")
+        return render_template("classreports.html", classes=sorted([row["class"] for row in classes], key=classkey))
+    else:
+        return redirect(url_for("home"))
+
+### Get a class report via ajax. Values: class (empty for the whole school), datefrom, dateto.
+### Returns the summaries (students, average, median, highest, lowest, distribution in bands of
+### CLASSREPORT_BAND percent) and rankings (marks, percentage, rank, percentile) of every subject and overall.
+@server.route("/getclassreport", methods=["GET", "POST"])
+def getclassreport():
+    if g.user:
+        report = classreport()
+        if report is None:
+            return jsonify([{"status": "error", "msg": "Incompatible data."}])
+        rankings, summaries = report
+        return jsonify({"summaries": summaries, "rankings": rankings})
+    else:
+        return redirect(url_for("home"))
+
+### Download a class report as CSV. Values: the filters of /getclassreport, report (rankings/summary)
+@server.route("/exportclassreport")
+def exportclassreport():
+    if g.user:
+        report = classreport()
+        name = request.values.get("report", "rankings")
+        if report is None or name not in ("rankings", "summary"):
+            return jsonify([{"status": "error", "msg": "Incompatible data."}])
+        rankings, summaries = report
+
+        output = io.StringIO()
+        writer = csv.writer(output)
+        if name == "rankings":
+            columns = ["class", "subject", "rank", "percentile", "percentage", "obtainedmarks", "totalmarks", "tests", "studentID", "firstname", "lastname", "fathername"]
+            writer.writerow(columns)
+            for ranking in rankings:
+                writer.writerow([ranking[column] if column != "subject" else ranking[column] or "Overall" for column in columns])
+        else:
+            bands = [str(i) + "-" + str(i + CLASSREPORT_BAND - 1 if i + CLASSREPORT_BAND < 100 else 100) for i in range(0, 100, CLASSREPORT_BAND)]
+            writer.writerow(["class", "subject", "students", "average", "median", "highest", "lowest"] + bands)
+            for summary in summaries:
+                writer.writerow([summary["class"], summary["subject"] or "Overall", summary["students"], summary["average"], summary["median"], summary["highest"], summary["lowest"]] + summary["distribution"])
+
+        filename = "class-" + re.sub(r"[^\w-]", "_", request.values.get("class", "").strip()) if request.values.get("class", "").strip() != "" else "school"
+        response = make_response(output.getvalue())
+        response.headers["Content-Type"] = "text/csv"
+        response.headers["Content-Disposition"] = "attachment; filename=" + filename + "-" + name + ".csv"
+        return response
+    else:
+        return redirect(url_for("home"))
+
+
 '''
     Fee Records
 '''
@@ -786,8 +2400,7 @@ def deletetestrecord(id):
 @server.route("/feerecords")
 def feerecords():
     if g.user:
-        records = db.execute("SELECT * FROM feerecords")
-        return render_template("feerecords.html", records=records)
+        return render_template("feerecords.html")
     else:
         return redirect(url_for("home"))
 
@@ -795,9 +2408,15 @@ def feerecords():
 @server.route("/allfeerecords")
 def allfeerecords():
     if g.user:
-        records = db.execute("SELECT * FROM feerecords")
-        records.reverse()
-        return render_template("allfeerecords.html", records=records)
+        return render_template("allfeerecords.html")
+    else:
+        return redirect(url_for("home"))
+
+### Get a page of fee records via ajax, newest first
+@server.route("/getfeerecords", methods=["GET", "POST"])
+def getfeerecords():
+    if g.user:
+        return recordspage("feerecords")
     else:
         return redirect(url_for("home"))
 
@@ -805,11 +2424,10 @@ def allfeerecords():
 @server.route("/feerecord/<id>")
 def fetchfeerecord(id):
     if g.user:
-        records = db.execute("SELECT * FROM feerecords WHERE studentID=:id", id=int(id))
+        records = db.execute("SELECT * FROM feerecords WHERE studentID=:id ORDER BY id DESC", id=int(id))
         if len(records) < 1:
             return render_template("notfound.html", msg="Record Not Found.")
         else:
-            records.reverse()
             return render_template("studentfeerecord.html", records=records)
     else:
         return redirect(url_for("home"))
@@ -850,7 +2468,7 @@ def addnewfeerecord():
                 return jsonify([{"status": "error", "msg": "No Student with entered ID."}])
 
 
-            lastR_ID = db.execute("INSERT INTO feerecords (studentID, studentName, studentFrName, date, feefor, depositedfee) VALUES (:studentID, :studentName, :studentFrName, :date, :feefor, :depositedfee)", studentID=int(student[0]["id"]), studentName=str(student[0]["firstname"] + " " + student[0]["lastname"]), studentFrName=student[0]["fathername"], date=date, feefor=feefor, depositedfee=int(depositedfee))
+            lastR_ID = db.execute("INSERT INTO feerecords (studentID, studentName, studentFrName, date, feefor, depositedfee, period, class, adminID) VALUES (:studentID, :studentName, :studentFrName, :date, :feefor, :depositedfee, :period, :class_, :adminID)", studentID=int(student[0]["id"]), studentName=str(student[0]["firstname"] + " " + student[0]["lastname"]), studentFrName=student[0]["fathername"], date=date, feefor=feefor, depositedfee=int(depositedfee), period=feerecordperiod(feefor, date), class_=student[0]["class"], adminID=int(g.user))
             
             return jsonify([{"status": "success", "msg": "Changes saved.", "lastrowID": lastR_ID}])
     else:
@@ -904,12 +2522,12 @@ def updatefeerecord(id):
             if len(student) < 1:
                 return jsonify([{"status": "error", "msg": "No Student with entered ID."}])
 
-            db.execute("UPDATE feerecords SET studentID=:studentID WHERE id=:id", studentID=studentID, id=int(id))
-            db.execute("UPDATE feerecords SET studentName=:studentName WHERE id=:id", studentName=studentName, id=int(id))
-            db.execute("UPDATE feerecords SET studentFrName=:studentFrName WHERE id=:id", studentFrName=studentFrName, id=int(id))
-            db.execute("UPDATE feerecords SET date=:date WHERE id=:id", date=date, id=int(id))
-            db.execute("UPDATE feerecords SET feefor=:feefor WHERE id=:id", feefor=feefor, id=int(id))
-            db.execute("UPDATE feerecords SET depositedfee=:depositedfee WHERE id=:id", depositedfee=depositedfee, id=int(id))
+            values = {"studentID": int(studentID), "studentName": studentName, "studentFrName": studentFrName, "date": date, "feefor": feefor, "depositedfee": int(depositedfee), "period": feerecordperiod(feefor, date)}
+            # a record keeps the class it was paid in (the rollups count it there), unless it is moved to another student
+            record = db.execute("SELECT studentID FROM feerecords WHERE id=:id", id=int(id))
+            if len(record) > 0 and record[0]["studentID"] != int(studentID):
+                values["class"] = student[0]["class"]
+            db.update("feerecords", int(id), values)
 
             return jsonify([{"status": "success", "msg": "Changes saved."}])
     else:
@@ -923,6 +2541,227 @@ def deletefeerecord(id):
     return redirect(url_for("feerecords"))
 
 
+'''
+    Outstanding Dues
+'''
+### Expected fees, deposits and balance of the active students owing fees up to and including a billing period.
+### A student owes monthlyfee for every month since the month of admission. Deposits count towards the
+### period they were paid for (see feerecordperiod). Sorted by balance, largest first.
+def outstandingdues(month, class_=None):
+    where = ""
+    params = {"month": month, "year": int(month[:4]), "monthofyear": int(month[5:7])}
+    if class_ is not None and class_ != "":
+        where = " AND students.class=:class"
+        params["class"] = class_
+    return db.execute("""
+        SELECT id, firstname, lastname, fathername, class, monthlyfee, months, monthlyfee * months AS expected, deposited, monthlyfee * months - deposited AS balance
+        FROM (
+            SELECT students.id, students.firstname, students.lastname, students.fathername, students.class, IFNULL(students.monthlyfee, 0) AS monthlyfee,
+                MAX(0, (:year - CAST(substr(students.admissiondate, 1, 4) AS INTEGER)) * 12 + :monthofyear - CAST(substr(students.admissiondate, 6, 2) AS INTEGER) + 1) AS months,
+                IFNULL(deposits.deposited, 0) AS deposited
+            FROM students
+            LEFT JOIN (
+                SELECT studentID, SUM(depositedfee) AS deposited FROM feerecords WHERE period<=:month GROUP BY studentID
+            ) AS deposits ON deposits.studentID=students.id
+            WHERE students.status='Active' AND students.admissiondate GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]*'""" + where + """
+        )
+        WHERE monthlyfee * months - deposited > 0
+        ORDER BY balance DESC, id
+    """, **params)
+
+### Outstanding dues page
+@server.route("/outstandingdues")
+def outstandingduespage():
+    if g.user:
+        return render_template("outstandingdues.html", month=time.strftime("%Y-%m"))
+    else:
+        return redirect(url_for("home"))
+
+### Get outstanding dues via ajax, optionally for one class, as of a month ("YYYY-MM", default the current month)
+@server.route("/getoutstandingdues", methods=["GET", "POST"])
+def getoutstandingdues():
+    if g.user:
+        month = request.values.get("month", "")
+        class_ = request.values.get("class", "")
+        if month == "":
+            month = time.strftime("%Y-%m")
+        if re.match(r"^\d{4}-(0[1-9]|1[0-2])$", month) is None:
+            return jsonify([{"status": "error", "msg": "Incompatible data."}])
+        dues = outstandingdues(month, class_)
+        return jsonify({"month": month, "class": class_, "total": sum(due["balance"] for due in dues), "dues": dues})
+    else:
+        return redirect(url_for("home"))
+
+'''
+    Fee Collections
+'''
+### Rebuild the fee collection rollups from scratch, e.g. after editing the database by hand
+def rebuildfeerollups():
+    with db.transaction() as transaction:
+        for statement in FEEROLLUPS_REBUILD:
+            transaction.execute(statement)
+
+### Columns the fee collection report can be grouped by
+FEECOLLECTIONS_GROUPS = {"month": "feerollups.month", "class": "feerollups.class", "admin": "feerollups.adminID"}
+
+### Fee collection totals from the rollups, for months between frommonth and tomonth ("YYYY-MM", inclusive),
+### grouped by any of "month", "class" and "admin"
+def feecollections(frommonth, tomonth, groupby, class_=None):
+    columns = [FEECOLLECTIONS_GROUPS[group] for group in groupby]
+    where = "feerollups.month>=:frommonth AND feerollups.month<=:tomonth AND feerollups.deposits>0"
+    params = {"frommonth": frommonth, "tomonth": tomonth}
+    if class_ is not None and class_ != "":
+        where += " AND feerollups.class=:class"
+        params["class"] = class_
+    select = list(columns)
+    if "admin" in groupby:
+        select.append("admins.firstname || ' ' || admins.lastname AS admin")
+    sql = "SELECT " + ", ".join(select + ["SUM(feerollups.deposits) AS deposits", "SUM(feerollups.amount) AS amount"]) + " FROM feerollups"
+    if "admin" in groupby:
+        sql += " LEFT JOIN admins ON admins.id=feerollups.adminID"
+    sql += " WHERE " + where
+    if len(columns) > 0:
+        sql += " GROUP BY " + ", ".join(columns) + " ORDER BY " + ", ".join(columns)
+    return db.execute(sql, **params)
+
+### Fee collections page
+@server.route("/feecollections")
+def feecollectionspage():
+    if g.user:
+        return render_template("feecollections.html", frommonth=time.strftime("%Y-01"), tomonth=time.strftime("%Y-%m"))
+    else:
+        return redirect(url_for("home"))
+
+### Get fee collection totals via ajax. Values: from, to ("YYYY-MM"), groupby (comma separated month/class/admin), class
+@server.route("/getfeecollections", methods=["GET", "POST"])
+def getfeecollections():
+    if g.user:
+        frommonth = request.values.get("from", "") or "0000-00"
+        tomonth = request.values.get("to", "") or "9999-99"
+        groupby = []
+        for group in request.values.get("groupby", "month").split(","):
+            if group != "" and group not in groupby:
+                groupby.append(group)
+        class_ = request.values.get("class", "")
+
+        if re.match(r"^\d{4}-\d{2}$", frommonth) is None or re.match(r"^\d{4}-\d{2}$", tomonth) is None:
+            return jsonify([{"status": "error", "msg": "Incompatible data."}])
+        for group in groupby:
+            if group not in FEECOLLECTIONS_GROUPS:
+                return jsonify([{"status": "error", "msg": "Incompatible data."}])
+
+        collections = feecollections(frommonth, tomonth, groupby, class_)
+        return jsonify({"groupby": groupby, "collections": collections})
+    else:
+        return redirect(url_for("home"))
+
+### Rebuild the fee collection rollups from the command line: FLASK_APP=server.py flask rebuild-rollups
+@server.cli.command("rebuild-rollups")
+def rebuildrollupscommand():
+    migrate(db)
+    rebuildfeerollups()
+    click.echo("Fee collection rollups rebuilt.")
+
+'''
+    Printing
+'''
+### Receipts and ID cards are rendered to PDF on the server (see pdf.py). Batches are split into chunks
+### of chunk_size rows that are rendered in a pool of worker processes and merged into one file.
+PRINT_CHUNK_SIZE = setting("printing", "chunk_size", 100)
+PRINT_MAX_PAGES = setting("printing", "max_pages", 5000)
+printpool = {"executor": None}
+printpool_lock = threading.Lock()
+
+def printexecutor():
+    with printpool_lock:
+        if printpool["executor"] is None:
+            workers = setting("printing", "workers", 0)
+            printpool["executor"] = concurrent.futures.ProcessPoolExecutor(max_workers=workers if workers > 0 else None, mp_context=multiprocessing.get_context("spawn"))
+        return printpool["executor"]
+
+### Render rows with one of the pdf.py print jobs, a single chunk is rendered in this process
+def renderpages(render, rows, *args):
+    chunks = [rows[i:i + PRINT_CHUNK_SIZE] for i in range(0, len(rows), PRINT_CHUNK_SIZE)]
+    if len(chunks) < 2:
+        return render(rows, *args)
+    try:
+        results = list(printexecutor().map(render, chunks, *[[arg] * len(chunks) for arg in args]))
+    except concurrent.futures.process.BrokenProcessPool:
+        with printpool_lock:
+            printpool["executor"] = None
+        results = [render(chunk, *args) for chunk in chunks]
+    return [page for result in results for page in result]
+
+### Send the pages as one PDF, or as a zip with one PDF per page
+def printresponse(pages, filenames, name, format):
+    if format == "zip":
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as archive:
+            for page, filename in zip(pages, filenames):
+                archive.writestr(filename, pdf.PDFDocument([page]).output())
+        response = make_response(output.getvalue())
+        response.headers["Content-Type"] = "application/zip"
+        response.headers["Content-Disposition"] = "attachment; filename=" + name + ".zip"
+    else:
+        response = make_response(pdf.PDFDocument(pages).output())
+        response.headers["Content-Type"] = "application/pdf"
+        response.headers["Content-Disposition"] = "attachment; filename=" + name + ".pdf"
+    return response
+
+### Print fee receipts. Values: the filters of the fee records page (studentID, class, feefor, period, datefrom, dateto), format (pdf/zip)
+@server.route("/printfeereceipts")
+def printfeereceipts():
+    if g.user:
+        format = request.values.get("format", "pdf")
+        if format not in ("pdf", "zip") or (request.values.get("studentID", "") != "" and RepresentsInt(request.values.get("studentID")) != True):
+            return jsonify([{"status": "error", "msg": "Incompatible data."}])
+
+        conditions, params = recordfilters("feerecords")
+        where = " WHERE " + " AND ".join(conditions) if len(conditions) > 0 else ""
+        records = db.execute("SELECT id, studentID, studentName, studentFrName, feefor, date, depositedfee FROM feerecords" + where + " ORDER BY id LIMIT :limit", limit=PRINT_MAX_PAGES + 1, **params)
+        if len(records) < 1:
+            return render_template("notfound.html", msg="No Records Found.")
+        if len(records) > PRINT_MAX_PAGES:
+            return render_template("notfound.html", msg="Too many records, narrow down the filters.")
+
+        pages = renderpages(pdf.feereceipts, records, g.systemsettings["institutionname"])
+        return printresponse(pages, ["fee_" + str(record["id"]) + ".pdf" for record in records], "fee_receipts", format)
+    else:
+        return redirect(url_for("home"))
+
+### Print student ID cards. Values: class, status (default Active), studentID, format (pdf/zip)
+@server.route("/printidcards")
+def printidcards():
+    if g.user:
+        format = request.values.get("format", "pdf")
+        studentID = request.values.get("studentID", "")
+        class_ = request.values.get("class", "").strip()
+        status = request.values.get("status", "Active")
+        if format not in ("pdf", "zip") or (studentID != "" and RepresentsInt(studentID) != True):
+            return jsonify([{"status": "error", "msg": "Incompatible data."}])
+
+        conditions = ["status=:status"]
+        params = {"status": status}
+        if class_ != "":
+            conditions.append("class=:class")
+            params["class"] = class_
+        if studentID != "":
+            conditions.append("id=:id")
+            params["id"] = int(studentID)
+        students = db.execute("SELECT id, firstname, lastname, fathername, class, imgURL FROM students WHERE " + " AND ".join(conditions) + " ORDER BY id LIMIT :limit", limit=PRINT_MAX_PAGES + 1, **params)
+        if len(students) < 1:
+            return render_template("notfound.html", msg="No Students Found.")
+        if len(students) > PRINT_MAX_PAGES:
+            return render_template("notfound.html", msg="Too many students, narrow down the filters.")
+
+        for student in students:
+            student["photo"] = imagepath(imagevariant(student["imgURL"], "card"))
+        pages = renderpages(pdf.idcards, students, imagepath("../static/img/system/logo.jpg"), imagepath("../static/img/system/default-prof-img.png"))
+        filenames = [re.sub(r"[\-\s]", "_", student["firstname"] + " " + student["lastname"]) + "_" + str(student["id"]) + "_Card.pdf" for student in students]
+        return printresponse(pages, filenames, "id_cards", format)
+    else:
+        return redirect(url_for("home"))
+
 '''
     System Settings
 '''
@@ -930,7 +2769,7 @@ def deletefeerecord(id):
 @server.route("/systemsettings")
 def systemsettings():
     if g.user and g.role == "root":
-        return render_template("systemsettings.html")
+        return render_template("systemsettings.html", pagedata=db.execute("SELECT * FROM systemsettings where id=:id", id=1))
     else:
         return redirect(url_for("home"))
 
@@ -938,8 +2777,8 @@ def systemsettings():
 @server.route("/getsystemsettings")
 def getsystemsettings():
     if g.user and g.role == "root":
-        systemsettings = db.execute("SELECT * FROM systemsettings where id=:id", id=1)
-        return jsonify(systemsettings)
+        version = db.execute("SELECT version FROM systemsettings WHERE id=:id", id=1)
+        return conditionaljson("systemsettings-" + str(version[0]["version"]), lambda: db.execute("SELECT * FROM systemsettings where id=:id", id=1))
     else:
         return redirect(url_for("home"))
 
@@ -964,14 +2803,15 @@ def savesystemsettings():
             if (nameinheader != "true" and nameinheader != "false") or (logoinheader != "true" and logoinheader != "false"):
                 return jsonify([{"status": "error", "msg": "Incompatible Values for true/false"}])
 
+            values = {"institutionname": institutionname, "nameinheader": nameinheader, "logoinheader": logoinheader}
+
             if pngURL:
                 if allowed_file(pngURL.filename) == True:
                     imagename = pngURL.filename
                     imageext = imagename.split(".")[-1]
                     imagename = "logo." + imageext
                     pngURL.save(os.path.join(THIS_FOLDER_G + "/static/img/system/", imagename))
-                    pngURL = "../static/img/system/" + imagename
-                    db.execute("UPDATE systemsettings SET pngURL=:pngURL WHERE id=:id", pngURL=pngURL, id=1)
+                    values["pngURL"] = "../static/img/system/" + imagename
                 else:
                     return jsonify([{"status": "error", "msg": "File extension not supported."}])
 
@@ -981,8 +2821,7 @@ def savesystemsettings():
                     imageext = imagename.split(".")[-1]
                     imagename = "logo." + imageext
                     jpgURL.save(os.path.join(THIS_FOLDER_G + "/static/img/system/", imagename))
-                    jpgURL = "../static/img/system/" + imagename
-                    db.execute("UPDATE systemsettings SET jpgURL=:jpgURL WHERE id=:id", jpgURL=jpgURL, id=1)
+                    values["jpgURL"] = "../static/img/system/" + imagename
                 else:
                     return jsonify([{"status": "error", "msg": "File extension not supported."}])
 
@@ -992,22 +2831,208 @@ def savesystemsettings():
                     imageext = imagename.split(".")[-1]
                     imagename = "logo." + imageext
                     icoURL.save(os.path.join(THIS_FOLDER_G + "/static/img/system/", imagename))
-                    icoURL = "../static/img/system/" + imagename
-                    db.execute("UPDATE systemsettings SET icoURL=:icoURL WHERE id=:id", icoURL=icoURL, id=1)
+                    values["icoURL"] = "../static/img/system/" + imagename
                 else:
                     return jsonify([{"status": "error", "msg": "File extension not supported."}])
 
-            db.execute("UPDATE systemsettings SET institutionname=:institutionname WHERE id=:id", institutionname=institutionname, id=1)
-            db.execute("UPDATE systemsettings SET nameinheader=:nameinheader WHERE id=:id", nameinheader=nameinheader, id=1)
-            db.execute("UPDATE systemsettings SET logoinheader=:logoinheader WHERE id=:id", logoinheader=logoinheader, id=1)
+            if db.update("systemsettings", 1, values, version="version") > 0:
+                with systemsettings_lock:
+                    loadsystemsettings()
 
             return jsonify([{"status": "success", "msg": "Changes saved."}])
     else:
         return redirect(url_for("home"))
 
 
+'''
+    Production
+'''
+SESSION_LIFETIME = setting("sessions", "lifetime", 86400)
+SESSION_SWEEP_INTERVAL = setting("sessions", "sweep_interval", 3600)
+
+### Session kept in the sessions table, the cookie only holds its signed id
+class SQLSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expires=0):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.modified = False
+
+### Sessions shared by every worker process. A session expires after SESSION_LIFETIME seconds without
+### requests; its row is refreshed once less than half of that is left, not on every request.
+class SQLSessionInterface(SessionInterface):
+    def __init__(self, database, lifetime):
+        self.database = database
+        self.lifetime = lifetime
+
+    def signer(self, app):
+        return Signer(app.secret_key, salt="session-id", key_derivation="hmac")
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(app.session_cookie_name)
+        if cookie:
+            try:
+                sid = self.signer(app).unsign(cookie).decode("utf-8")
+            except BadSignature:
+                sid = None
+            if sid:
+                rows = self.database.execute("SELECT data, expires FROM sessions WHERE id=:id AND expires>:now", id=sid, now=int(time.time()))
+                if len(rows) > 0:
+                    return SQLSession(session_json_serializer.loads(rows[0]["data"]), sid, rows[0]["expires"])
+        return SQLSession(sid=uuid.uuid4().hex)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            # emptied by logout
+            if session.modified:
+                self.database.execute("DELETE FROM sessions WHERE id=:id", id=session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+
+        now = int(time.time())
+        if session.modified or session.expires - now < self.lifetime / 2:
+            self.database.execute("INSERT OR REPLACE INTO sessions (id, data, expires) VALUES (:id, :data, :expires)", id=session.sid, data=session_json_serializer.dumps(dict(session)), expires=now + self.lifetime)
+        if session.expires == 0:
+            response.set_cookie(app.session_cookie_name, self.signer(app).sign(session.sid.encode("utf-8")).decode("utf-8"),
+                                domain=domain, path=path, httponly=self.get_cookie_httponly(app), secure=self.get_cookie_secure(app))
+
+def sweepsessions():
+    return db.execute("DELETE FROM sessions WHERE expires<=:now", now=int(time.time()))
+
+sessionsweeper = {"thread": None}
+
+def sessionsweeperloop():
+    while True:
+        time.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            sweepsessions()
+        except RuntimeError:
+            # database busy, try again next time
+            pass
+
+### Start sweeping expired sessions once a worker is serving, only the production app stores them
+@server.before_first_request
+def startsessionsweeper():
+    if isinstance(server.session_interface, SQLSessionInterface) and SESSION_SWEEP_INTERVAL > 0 and sessionsweeper["thread"] is None:
+        sessionsweeper["thread"] = threading.Thread(target=sessionsweeperloop, name="sessionsweeper")
+        sessionsweeper["thread"].daemon = True
+        sessionsweeper["thread"].start()
+
+### The key signing the session cookies. It is created once and kept in a file, so every worker process
+### and every restart uses the same one. A key in the config takes precedence over the file.
+def secretkey():
+    key = setting("sessions", "secret_key", "")
+    if key != "":
+        return key
+    path = os.path.join(THIS_FOLDER_G, setting("sessions", "secret_key_file", "db/secret_key"))
+    if not os.path.isfile(path):
+        temporary = path + "." + uuid.uuid4().hex + ".tmp"
+        with open(temporary, "w") as f:
+            f.write(os.urandom(32).hex())
+        try:
+            # fails if another worker created the file first, theirs is used then
+            os.link(temporary, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temporary)
+    with open(path) as f:
+        return f.read().strip()
+
+### App for production WSGI servers running several worker processes, e.g.
+###     gunicorn --workers 4 "server:create_app()"
+### Sessions live in the database under a persistent secret key, so any worker can serve any request
+### and restarts don't log anyone out. The desktop app (run_server) keeps its cookie sessions.
+def create_app():
+    migrate(db)
+    buildstatic()
+    sweepsessions()
+    server.secret_key = secretkey()
+    server.config["SESSION_COOKIE_SECURE"] = setting("sessions", "secure_cookie", False)
+    server.session_interface = SQLSessionInterface(db, SESSION_LIFETIME)
+    # a preloading server forks the workers after this, they must not share its SQLite connections
+    db.engine.dispose()
+    return server
+
+
+'''
+    Serving
+'''
+SERVER_THREADS = setting("server", "threads", 8)
+SERVER_TIMEOUT = setting("server", "timeout", 120)
+SERVER_BACKLOG = setting("server", "backlog", 64)
+
+### Serve the production app with gunicorn: worker processes forked from a master that loaded the app once,
+### recycled after max_requests, killed when a request takes longer than the timeout. kill -HUP <pid>
+### replaces the workers gracefully (kill -USR2 <pid> starts a new master, to load changed code).
+def servegunicorn(host, port, workers, threads):
+    options = {
+        "bind": host + ":" + str(port),
+        "workers": workers,
+        "threads": threads,
+        "worker_class": "gthread" if threads > 1 else "sync",
+        "timeout": SERVER_TIMEOUT,
+        "graceful_timeout": setting("server", "graceful_timeout", 30),
+        "keepalive": setting("server", "keepalive", 5),
+        "backlog": SERVER_BACKLOG,
+        "max_requests": setting("server", "max_requests", 1000),
+        "max_requests_jitter": setting("server", "max_requests_jitter", 100),
+        "pidfile": setting("server", "pidfile", "") or None,
+        "preload_app": True
+    }
+
+    class Application(gunicorn.app.base.BaseApplication):
+        def load_config(self):
+            for name, value in options.items():
+                self.cfg.set(name, value)
+
+        def load(self):
+            return create_app()
+
+    Application().run()
+
+### Serve an app in this process with waitress: a fixed pool of threads behind a bounded number of
+### connections, closing the ones idle for longer than the timeout. Runs in any thread, on any platform.
+def servewaitress(app, host, port, threads):
+    waitress.serve(app, host=host, port=port, threads=threads, backlog=SERVER_BACKLOG,
+                   connection_limit=setting("server", "connection_limit", 100), channel_timeout=SERVER_TIMEOUT)
+
+### Serve the production app: FLASK_APP=server.py flask serve
+### gunicorn is used when it is installed, waitress otherwise (one process, e.g. on Windows)
+@server.cli.command("serve")
+@click.option("--host", default=setting("server", "host", "127.0.0.1"), help="Address to listen on.")
+@click.option("--port", type=int, default=setting("server", "port", 5100), help="Port to listen on.")
+@click.option("--workers", type=int, default=setting("server", "workers", 0), help="Worker processes, 0 uses two per CPU.")
+@click.option("--threads", type=int, default=SERVER_THREADS, help="Threads per worker process.")
+@click.option("--engine", type=click.Choice(["gunicorn", "waitress"]), default=None, help="WSGI server to use.")
+def servecommand(host, port, workers, threads, engine):
+    if engine is None:
+        engine = "gunicorn" if gunicorn is not None else "waitress"
+    if engine == "gunicorn":
+        if gunicorn is None:
+            raise click.ClickException("gunicorn is not installed.")
+        servegunicorn(host, port, workers if workers > 0 else 2 * multiprocessing.cpu_count(), threads)
+    else:
+        if waitress is None:
+            raise click.ClickException("waitress is not installed.")
+        if workers > 1:
+            click.echo("waitress serves from a single process, --workers is ignored.", err=True)
+        servewaitress(create_app(), host, port, threads)
+
+
+### Desktop app (main.pyw) and python server.py: serves on localhost from a thread of this process,
+### with waitress if it is installed
 def run_server():
-    server.run(host="127.0.0.1", port=5100, threaded=True)
+    migrate(db)
+    buildstatic()
+    if waitress is not None:
+        servewaitress(server, "127.0.0.1", 5100, SERVER_THREADS)
+    else:
+        server.run(host="127.0.0.1", port=5100, threaded=True)
     # server.run(debug=True)
 
 
@@ -0,0 +1,50 @@
+// Cursor paging for the server-side record tables, see recordspage.
+// The ID each page ends at is remembered, so a page up to two pages after one already seen is asked
+// for as the records before that ID (plus "skip" rows) instead of by its offset from the newest record.
+// Pages further away are left to the server, which reads them from the nearer end of the table.
+// $(table).DataTable({serverSide: true, ajax: recordCursors(url, function (d) { ...filters... }), ...})
+function recordCursors(url, filters) {
+    var cursors = {};
+    var query = null;
+    var start = 0;
+    var length = 0;
+
+    return {
+        url: url,
+        type: 'POST',
+        data: function (d) {
+            filters(d);
+
+            // cursors only hold for the filters, search and page length they were seen with
+            var current = $.extend({}, d);
+            delete current.draw;
+            delete current.start;
+            current = JSON.stringify(current);
+            if (current !== query) {
+                cursors = {};
+                query = current;
+            }
+
+            var nearest = 0;
+            $.each(cursors, function (pagestart) {
+                pagestart = parseInt(pagestart, 10);
+                if (pagestart <= d.start && pagestart > nearest) {
+                    nearest = pagestart;
+                }
+            });
+            if (nearest > 0 && d.start - nearest <= 2 * d.length) {
+                d.before = cursors[nearest];
+                d.skip = d.start - nearest;
+            }
+            start = d.start;
+            length = d.length;
+        },
+        dataSrc: function (json) {
+            var data = json.data || [];
+            if (length > 0 && data.length == length) {
+                cursors[start + length] = data[data.length - 1].id;
+            }
+            return data;
+        }
+    };
+}
@@ -0,0 +1,98 @@
+// Typeahead for the student search boxes, suggestions come from /searchstudents.
+// $(input).studentSearch(function (student) { ... }) calls the function with the chosen student.
+(function ($) {
+    $.fn.studentSearch = function (onSelect) {
+        return this.each(function () {
+            var input = $(this);
+            var menu = $('<ul class="dropdown-menu student-search-menu"></ul>').insertAfter(input);
+            var students = [];
+            var active = -1;
+            var timer = null;
+            var request = null;
+
+            input.attr("autocomplete", "off").parent().addClass("dropdown");
+
+            function hide() {
+                menu.hide();
+                active = -1;
+            }
+
+            function highlight(i) {
+                menu.children().removeClass("active");
+                active = i;
+                if (i >= 0) {
+                    menu.children().eq(i).addClass("active");
+                }
+            }
+
+            function choose(i) {
+                var student = students[i];
+                input.val(student.firstname + " " + student.lastname);
+                hide();
+                onSelect(student);
+            }
+
+            function show(data) {
+                students = data;
+                menu.empty();
+                if (students.length < 1) {
+                    hide();
+                    return;
+                }
+                $.each(students, function (i, student) {
+                    var item = $('<li><a href="#"><img class="student-search-img"> <span></span><br><small class="text-muted"></small></a></li>');
+                    item.find("img").attr("src", student.thumbURL);
+                    item.find("span").text(student.firstname + " " + student.lastname);
+                    item.find("small").text("ID: " + student.id + " | Father: " + (student.fathername || "") + " | Class: " + (student.class || "") + (student.status == "Inactive" ? " | Inactive" : ""));
+                    // mousedown comes before the input's blur
+                    item.on("mousedown", function (e) {
+                        e.preventDefault();
+                        choose(i);
+                    });
+                    menu.append(item);
+                });
+                highlight(0);
+                menu.show();
+            }
+
+            input.on("input", function () {
+                var q = $.trim(input.val());
+                clearTimeout(timer);
+                if (q.length < 2 && !/^\d+$/.test(q)) {
+                    hide();
+                    return;
+                }
+                timer = setTimeout(function () {
+                    if (request) {
+                        request.abort();
+                    }
+                    request = $.get("/searchstudents", {
+                        q: q
+                    })
+                    .done(show);
+                }, 150);
+            });
+
+            input.on("keydown", function (e) {
+                if (!menu.is(":visible")) {
+                    return;
+                }
+                if (e.which == 40) {
+                    e.preventDefault();
+                    highlight(Math.min(active + 1, students.length - 1));
+                } else if (e.which == 38) {
+                    e.preventDefault();
+                    highlight(Math.max(active - 1, 0));
+                } else if (e.which == 13 && active >= 0) {
+                    e.preventDefault();
+                    choose(active);
+                } else if (e.which == 27) {
+                    e.stopPropagation();
+                    hide();
+                }
+            });
+
+            input.on("blur", hide);
+        });
+    };
+})(jQuery);
@@ -0,0 +1,33 @@
+import os, sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from server import billingperiod
+
+
+class BillingPeriodTest(unittest.TestCase):
+    def test_numeric(self):
+        self.assertEqual(billingperiod("2017-01"), "2017-01")
+        self.assertEqual(billingperiod("01/2017"), "2017-01")
+        self.assertEqual(billingperiod("3-17"), "2017-03")
+
+    def test_month_names(self):
+        self.assertEqual(billingperiod("January 2017"), "2017-01")
+        self.assertEqual(billingperiod("Jan-17"), "2017-01")
+        self.assertEqual(billingperiod("Sept. 2018"), "2018-09")
+        self.assertEqual(billingperiod("Fee for June, 2019"), "2019-06")
+        self.assertEqual(billingperiod("March", "2018"), "2018-03")
+        self.assertIsNone(billingperiod("March"))
+
+    def test_several_months(self):
+        self.assertEqual(billingperiod("Feb/March 2018", "2017"), "2018-02")
+        self.assertEqual(billingperiod("Jan and Feb 2019", "2017"), "2019-01")
+
+    def test_words_that_are_not_months(self):
+        for text in ("Maybe later", "Junior section", "Decoration", "Novel", "Separate", "Marks", "Augmented", "Octave"):
+            self.assertIsNone(billingperiod(text, "2018"), text)
+        self.assertEqual(billingperiod("Junior section, May 2018"), "2018-05")
+
+
+if __name__ == "__main__":
+    unittest.main()